@@ -0,0 +1,223 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from argparse import Namespace
+import numpy as np
+import torch
+import cv2
+from PIL import Image
+from core.extractor import MultiBasicEncoder
+from core.update import BasicMultiUpdateBlock, ConvGRU
+from core.corr import CorrBlock1D, PytorchAlternateCorrBlock1D
+from core.raft_stereo import RAFTStereo
+from core.utils.utils import InputPadder, coords_grid
+from core.utils import frame_utils
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "cpu.json")
+
+# realtime checkpoint architecture at 256x640 (1/8 resolution feature maps of 32x80)
+ARGS = Namespace(hidden_dims=[128]*3, context_norm='batch', n_downsample=3, n_gru_layers=2, shared_backbone=True,
+                 corr_levels=4, corr_radius=4, corr_implementation='alt', slow_fast_gru=True, mixed_precision=False)
+HEIGHT, WIDTH = 256, 640
+FMAP_H, FMAP_W = HEIGHT // 8, WIDTH // 8
+# removed at interpreter exit
+FRAME_DIR = tempfile.TemporaryDirectory()
+
+
+def bench_multi_basic_encoder():
+    cnet = MultiBasicEncoder(output_dim=[ARGS.hidden_dims, ARGS.hidden_dims], norm_fn='batch', downsample=3).eval()
+    images = torch.randn(2, 3, HEIGHT, WIDTH)
+    return lambda: cnet(images, dual_inp=True, num_layers=2)
+
+
+def bench_update_block_step():
+    update_block = BasicMultiUpdateBlock(ARGS, hidden_dims=ARGS.hidden_dims).eval()
+    net = [torch.randn(1, 128, FMAP_H // 2**i, FMAP_W // 2**i) for i in range(3)]
+    inp = [[torch.randn(1, 128, FMAP_H // 2**i, FMAP_W // 2**i) for _ in range(3)] for i in range(3)]
+    corr = torch.randn(1, ARGS.corr_levels * 9, FMAP_H, FMAP_W)
+    flow = torch.randn(1, 2, FMAP_H, FMAP_W)
+    return lambda: update_block(list(net), inp, corr, flow, iter32=False, iter16=True)
+
+
+def bench_conv_gru():
+    gru = ConvGRU(128, 128 + 128).eval()
+    h = torch.randn(1, 128, FMAP_H, FMAP_W)
+    cz, cr, cq = [torch.randn(1, 128, FMAP_H, FMAP_W) for _ in range(3)]
+    x = [torch.randn(1, 128, FMAP_H, FMAP_W), torch.randn(1, 128, FMAP_H, FMAP_W)]
+    return lambda: gru(h, cz, cr, cq, *x)
+
+
+def _corr_lookup(corr_block):
+    fmap1, fmap2 = torch.randn(1, 256, FMAP_H, FMAP_W), torch.randn(1, 256, FMAP_H, FMAP_W)
+    corr_fn = corr_block(fmap1, fmap2, num_levels=ARGS.corr_levels, radius=ARGS.corr_radius)
+    coords = coords_grid(1, FMAP_H, FMAP_W)
+    coords[:, 0] -= torch.rand(1, FMAP_H, FMAP_W) * FMAP_W / 4
+    return lambda: corr_fn(coords)
+
+
+def bench_corr_lookup_reg():
+    return _corr_lookup(CorrBlock1D)
+
+
+def bench_corr_lookup_alt():
+    return _corr_lookup(PytorchAlternateCorrBlock1D)
+
+
+def bench_upsample_flow():
+    model = RAFTStereo(ARGS).eval()
+    flow = torch.randn(1, 2, FMAP_H, FMAP_W)
+    mask = torch.randn(1, 9 * 64, FMAP_H, FMAP_W)
+    return lambda: model.upsample_flow(flow, mask)
+
+
+def bench_input_padder():
+    image1, image2 = torch.randn(1, 3, 375, 1242), torch.randn(1, 3, 375, 1242)
+    def run():
+        padder = InputPadder(image1.shape, divis_by=32)
+        padded = padder.pad(image1, image2)
+        return padder.unpad(padded[0])
+    return run
+
+
+def _frame_reader(name, write, read):
+    path = os.path.join(FRAME_DIR.name, name)
+    write(path)
+    return lambda: read(path)
+
+
+def bench_read_pfm():
+    disp = np.random.rand(375, 1242).astype(np.float32) * 100
+    return _frame_reader("disp.pfm", lambda p: frame_utils.writePFM(p, disp), frame_utils.readPFM)
+
+
+def bench_read_disp_kitti():
+    disp = (np.random.rand(375, 1242) * 100 * 256).astype(np.uint16)
+    return _frame_reader("disp_kitti.png", lambda p: cv2.imwrite(p, disp), frame_utils.readDispKITTI)
+
+
+def bench_read_gen_png():
+    image = (np.random.rand(375, 1242, 3) * 255).astype(np.uint8)
+    return _frame_reader("image.png", lambda p: Image.fromarray(image).save(p), lambda p: np.array(frame_utils.read_gen(p)))
+
+
+BENCHMARKS = {
+    "multi_basic_encoder": bench_multi_basic_encoder,
+    "update_block_step": bench_update_block_step,
+    "conv_gru": bench_conv_gru,
+    "corr_lookup_reg": bench_corr_lookup_reg,
+    "corr_lookup_alt": bench_corr_lookup_alt,
+    "upsample_flow": bench_upsample_flow,
+    "input_padder": bench_input_padder,
+    "read_pfm": bench_read_pfm,
+    "read_disp_kitti": bench_read_disp_kitti,
+    "read_gen_png": bench_read_gen_png,
+}
+
+
+def cpu_model():
+    """ CPU model name, platform.processor() is empty on most Linux systems """
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def host_info(threads):
+    """ Host, library and source revision the timings were taken on, stored with the baseline """
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return dict(cpu=cpu_model(), cpu_count=os.cpu_count(), machine=platform.machine(), system=platform.platform(),
+                python=platform.python_version(), torch=torch.__version__, numpy=np.__version__, opencv=cv2.__version__,
+                threads=threads, revision=revision)
+
+
+def measure(fn, warmup, repeats):
+    """ Median wall time of fn in ms """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            fn()
+            times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        results[name] = measure(setup(), args.warmup, args.repeats)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        meta = host_info(args.threads)
+        with open(args.baseline, "w") as f:
+            json.dump(dict(meta=meta, results_ms=results), f, indent=2)
+        for name, ms in results.items():
+            print(f"{name:24s} {ms:10.3f} ms")
+        print(f"Saved baseline: {args.baseline}")
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved["results_ms"]
+        # timings only compare on the same host and toolchain, name what differs rather than failing on it
+        current = host_info(args.threads)
+        differences = [f"{k}: {saved['meta'].get(k)} -> {current[k]}" for k in ("cpu", "cpu_count", "machine", "torch", "threads")
+                       if saved["meta"].get(k) != current[k]]
+        if differences:
+            print("Baseline taken on a different host or toolchain (" + ", ".join(differences) + "), rerun --save_baseline here")
+
+    regressions = []
+    print(f"{'benchmark':24s} {'current':>10s} {'baseline':>10s} {'change':>8s}")
+    for name, ms in results.items():
+        if name not in baseline:
+            print(f"{name:24s} {ms:8.3f}ms {'-':>10s} {'-':>8s}")
+            continue
+        change = ms / baseline[name] - 1
+        flag = ""
+        if change > args.threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:24s} {ms:8.3f}ms {baseline[name]:8.3f}ms {change * 100:+7.1f}%{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline JSON to compare against or write")
+    parser.add_argument('--save_baseline', action='store_true', help="write the current timings as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="fail when a benchmark is slower than baseline by this fraction")
+    parser.add_argument('--filter', nargs='+', default=None, help="only run benchmarks whose name contains one of these")
+    parser.add_argument('--warmup', type=int, default=3, help="untimed runs per benchmark")
+    parser.add_argument('--repeats', type=int, default=20, help="timed runs per benchmark (median is reported)")
+    parser.add_argument('--threads', type=int, default=1, help="torch CPU threads, keep fixed for comparable baselines")
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,157 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import resource
+import time
+import torch
+from core.corr import CorrBlock1D, CorrBlock1DBand, PytorchAlternateCorrBlock1D, PytorchAlternateCorrBlock1DFast, CorrBlockFast1D, AlternateCorrBlock
+from core.utils.utils import coords_grid
+
+CORR_BLOCKS = {
+    "reg": CorrBlock1D,
+    "band": CorrBlock1DBand,
+    "alt": PytorchAlternateCorrBlock1D,
+    "alt_fast": PytorchAlternateCorrBlock1DFast,
+    "reg_cuda": CorrBlockFast1D,
+    "alt_cuda": AlternateCorrBlock,
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case, queue):
+    """ Runs in a fresh process so the peak RSS delta belongs to this case only """
+    try:
+        torch.set_num_threads(case["threads"])
+        torch.manual_seed(0)
+        B, D, H, W = case["batch"], case["dim"], case["fmap_h"], case["fmap_w"]
+        fmap1 = torch.randn(B, D, H, W)
+        fmap2 = torch.randn(B, D, H, W)
+        coords = coords_grid(B, H, W)
+        coords[:, 0] -= torch.rand(B, H, W) * min(W / 4, case["max_disp"])
+        baseline = peak_rss_mb()
+
+        with torch.no_grad():
+            t0 = time.perf_counter()
+            kwargs = dict(max_disp=case["max_disp"]) if case["impl"] == "band" else {}
+            corr_fn = CORR_BLOCKS[case["impl"]](fmap1, fmap2, num_levels=case["levels"], radius=case["radius"], **kwargs)
+            t1 = time.perf_counter()
+            corr_fn(coords)
+            t2 = time.perf_counter()
+            for _ in range(case["lookups"]):
+                corr_fn(coords)
+            t3 = time.perf_counter()
+
+        queue.put(dict(case, construct_ms=(t1 - t0) * 1000, first_lookup_ms=(t2 - t1) * 1000,
+                       lookup_ms=(t3 - t2) * 1000 / case["lookups"], peak_mb=peak_rss_mb() - baseline))
+    except Exception as e:
+        queue.put(dict(case, error=f"{type(e).__name__}: {e}"))
+
+
+def run_isolated(case, ctx):
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_case, args=(case, queue))
+    proc.start()
+    proc.join()
+    if queue.empty():
+        return dict(case, error=f"exit code {proc.exitcode}")
+    return queue.get()
+
+
+def format_table(results):
+    header = "| impl | image | fmap | radius | levels | construct (ms) | lookup (ms) | peak mem (MB) |"
+    lines = [header, "|---" * (header.count("|") - 1) + "|"]
+    for r in results:
+        row = f"| {r['impl']} | {r['height']}x{r['width']} | {r['fmap_h']}x{r['fmap_w']} | {r['radius']} | {r['levels']} |"
+        if "error" in r:
+            row += f" n/a | n/a | {r['error'][:60]} |"
+        else:
+            row += f" {r['construct_ms']:.2f} | {r['lookup_ms']:.2f} | {r['peak_mb']:.1f} |"
+        lines.append(row)
+    return "\n".join(lines)
+
+
+def fit_cost_constants(results):
+    """ Constants of core.corr.estimate_corr_cost from benchmark results: the median over the cases of each
+    implementation of ns per all-pairs multiply-add, ns per lookup tap (per tap and channel for alt) and
+    live volumes / feature maps at the peak (base and per window tap for alt) """
+    fits = {}
+    for impl, prefix in (("reg", "REG"), ("reg_cuda", "REG_CUDA"), ("alt", "ALT")):
+        cases = [r for r in results if r["impl"] == impl and "error" not in r]
+        if not cases:
+            continue
+        per_case = []
+        for r in cases:
+            B, D, H, W = r["batch"], r["dim"], r["fmap_h"], r["fmap_w"]
+            taps = B * H * W * r["levels"] * (2 * r["radius"] + 1)
+            if impl == "alt":
+                per_case.append(dict(ALT_LOOKUP_NS=r["lookup_ms"] * 1e6 / (taps * D)))
+            else:
+                volume = B * H * W * W
+                per_case.append({f"{prefix}_VOLUME_NS": r["construct_ms"] * 1e6 / (volume * D),
+                                 f"{prefix}_LOOKUP_NS": r["lookup_ms"] * 1e6 / taps,
+                                 f"{prefix}_PEAK_VOLUMES": r["peak_mb"] * 2**20 / (4 * volume)})
+        for name in per_case[0]:
+            values = sorted(c[name] for c in per_case)
+            fits[name] = values[len(values) // 2]
+        if impl == "alt":
+            # the sampled slices of fmap2 grow with the window: least squares of fmaps = base + per_tap * (2r + 1)
+            xs = [2 * r["radius"] + 1 for r in cases]
+            ys = [r["peak_mb"] * 2**20 / (4 * r["batch"] * r["dim"] * r["fmap_h"] * r["fmap_w"]) for r in cases]
+            x_mean, y_mean = sum(xs) / len(xs), sum(ys) / len(ys)
+            var = sum((x - x_mean) ** 2 for x in xs)
+            per_tap = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / var if var > 0 else 0.0
+            fits["ALT_PEAK_FMAPS"] = y_mean - per_tap * x_mean
+            fits["ALT_PEAK_FMAPS_PER_TAP"] = per_tap
+    return fits
+
+
+def main(args):
+    ctx = mp.get_context("fork")
+    results = []
+    for size, radius, levels, impl in itertools.product(args.sizes, args.radius, args.levels, args.impls):
+        height, width = map(int, size.split("x"))
+        factor = 2 ** args.n_downsample
+        case = dict(impl=impl, height=height, width=width, fmap_h=height // factor, fmap_w=width // factor,
+                    batch=args.batch, dim=args.dim, radius=radius, levels=levels, lookups=args.lookups,
+                    threads=args.threads, max_disp=args.max_disp / factor)
+        result = run_isolated(case, ctx)
+        results.append(result)
+        print(format_table([result]).splitlines()[-1], flush=True)
+
+    print()
+    print(format_table(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved: {args.output}")
+    if args.fit:
+        print()
+        for name, value in fit_cost_constants(results).items():
+            print(f"{name} = {value:.3g}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--impls', nargs='+', default=["reg", "band", "alt", "alt_fast", "reg_cuda", "alt_cuda"], choices=list(CORR_BLOCKS), help="correlation implementations to benchmark")
+    parser.add_argument('--sizes', nargs='+', default=["256x640", "384x1280", "544x1920"], help="image sizes as HxW")
+    parser.add_argument('--radius', nargs='+', type=int, default=[1, 4], help="correlation radii")
+    parser.add_argument('--levels', nargs='+', type=int, default=[2, 4], help="correlation pyramid levels")
+    parser.add_argument('--n_downsample', type=int, default=3, help="resolution of the feature maps (1/2^K)")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (image pixels) of the band implementation")
+    parser.add_argument('--dim', type=int, default=256, help="feature dimension")
+    parser.add_argument('--batch', type=int, default=1, help="batch size")
+    parser.add_argument('--lookups', type=int, default=10, help="number of timed lookups per case")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="torch CPU threads")
+    parser.add_argument('--output', default=None, help="save raw results as JSON")
+    parser.add_argument('--fit', action='store_true', help="print the cost constants of core/corr.py fitted to these results")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,84 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import torch
+from core.raft_stereo import RAFTStereo
+from core.checkpoint import load_model
+from core.corr import CorrBlock1D, CorrBlock1DBand, PytorchAlternateCorrBlock1D, PytorchAlternateCorrBlock1DFast
+from core.utils.utils import InputPadder
+from bench_slow_fast import load_samples, run_model, end_point_error
+
+CORR_BLOCKS = {
+    "reg": CorrBlock1D,
+    "band": CorrBlock1DBand,
+    "alt": PytorchAlternateCorrBlock1D,
+    "alt_fast": PytorchAlternateCorrBlock1DFast,
+}
+
+
+def storage_mb(args, impl, dtype, shape):
+    """ Size of the tensors a lookup reads: the correlation pyramid, or the fmap2 pyramid for alt """
+    fmap1, fmap2 = torch.randn(shape), torch.randn(shape)
+    kwargs = dict(max_disp=args.max_disp / 2**args.n_downsample) if impl == "band" else {}
+    block = CORR_BLOCKS[impl](fmap1, fmap2, num_levels=args.corr_levels, radius=args.corr_radius,
+                              storage_dtype=getattr(torch, dtype), **kwargs)
+    tensors = block.fmap2_pyramid if impl.startswith("alt") else block.corr_pyramid[:args.corr_levels]
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    model = load_model(RAFTStereo(args), args.restore_ckpt)
+    model.eval()
+
+    samples = load_samples(args)
+    padded = InputPadder(samples[0][0].shape, divis_by=32).pad(samples[0][0][None])[0].shape
+    factor = 2 ** args.n_downsample
+    fmap_shape = (1, 256, padded[-2] // factor, padded[-1] // factor)
+
+    has_gt = samples[0][2] is not None
+    print(f"{len(samples)} samples, {args.valid_iters} iterations, feature maps {fmap_shape[2]}x{fmap_shape[3]}, "
+          f"EPE against {'ground truth' if has_gt else 'float32 of the same implementation'}")
+    print("| impl | dtype | storage (MB) | latency (ms) | EPE | >1px (%) |")
+    print("|---|---|---|---|---|---|")
+    for impl in args.impls:
+        args.corr_implementation = impl
+        reference = None
+        for dtype in ["float32"] + [d for d in args.dtypes if d != "float32"]:
+            args.corr_dtype = dtype
+            ms, predictions = run_model(model, samples, args.valid_iters)
+            if reference is None:
+                reference = predictions
+            targets = [s[2] for s in samples] if has_gt else reference
+            valids = [s[3] for s in samples] if has_gt else [None] * len(samples)
+            epe, bad = end_point_error(predictions, targets, valids)
+            print(f"| {impl} | {dtype} | {storage_mb(args, impl, dtype, fmap_shape):.1f} | {ms:.1f} | {epe:.4f} | {bad:.3f} |", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restore_ckpt', help="restore checkpoint", required=True)
+    parser.add_argument('--impls', nargs='+', default=["reg", "alt"], choices=list(CORR_BLOCKS), help="correlation implementations to compare")
+    parser.add_argument('--dtypes', nargs='+', default=["float16", "bfloat16"], choices=["float32", "float16", "bfloat16"], help="storage dtypes compared to float32")
+    parser.add_argument('--dataset', choices=["eth3d", "kitti", "middlebury_F", "middlebury_H", "middlebury_Q"], default=None,
+                        help="evaluate against ground truth, otherwise the ../python/examples images are compared to float32")
+    parser.add_argument('--max_samples', type=int, default=10, help="number of image pairs")
+    parser.add_argument('--valid_iters', type=int, default=7, help='number of flow-field updates during forward pass')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="torch CPU threads")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (pixels) covered by the band implementation")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    args = parser.parse_args()
+    args.corr_implementation = args.impls[0]
+    main(args)
@@ -0,0 +1,80 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import time
+import numpy as np
+import torch
+from core.raft_stereo import RAFTStereo
+from core.utils.utils import forward_interpolate
+
+VARIANTS = [("griddata", {"method": "griddata"}),
+            ("nearest/zbuffer", {"splat": "nearest", "resolve": "zbuffer"}),
+            ("nearest/average", {"splat": "nearest", "resolve": "average"}),
+            ("bilinear/zbuffer", {"splat": "bilinear", "resolve": "zbuffer"}),
+            ("bilinear/average", {"splat": "bilinear", "resolve": "average"})]
+
+
+def median_ms(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def gru_iteration_ms(args, H, W):
+    """ Cost of one flow update, the difference between refining for 2 and for 1 iterations """
+    model = RAFTStereo(args).eval()
+    image = torch.rand(1, 3, H, W) * 255
+    with torch.no_grad():
+        reference = model.encode_reference(image)
+        fmap2 = model.encode_partner(image)
+        run = lambda iters: model.refine(list(reference['net_list']), reference['inp_list'], reference['fmap1'], fmap2, iters, test_mode=True)
+        return median_ms(lambda: run(2), args.repeats) - median_ms(lambda: run(1), args.repeats)
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    factor = 2 ** args.n_downsample
+    H, W = args.height // factor, args.width // factor
+
+    # a fronto-parallel background with a closer box, the box occludes part of the background when warped
+    disp = torch.full((H, W), args.max_disp / factor / 4)
+    disp[H // 4:H // 2, W // 3:W // 2] = args.max_disp / factor / 2
+    flow = torch.stack([-disp, torch.zeros_like(disp)])
+    reference = forward_interpolate(flow, method="griddata")
+
+    print(f"flow {H}x{W}, one GRU iteration: {gru_iteration_ms(args, args.height, args.width):.2f} ms")
+    print("| variant | latency (ms) | mean |diff| to griddata |")
+    print("|---|---|---|")
+    for name, kwargs in VARIANTS:
+        ms = median_ms(lambda: forward_interpolate(flow, **kwargs), args.repeats)
+        diff = (forward_interpolate(flow, **kwargs) - reference).abs().mean().item()
+        print(f"| {name} | {ms:.2f} | {diff:.4f} |")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=640, help="model input width")
+    parser.add_argument('--height', type=int, default=256, help="model input height")
+    parser.add_argument('--max_disp', type=int, default=192, help="disparity (pixels) of the synthetic scene is up to half of this")
+    parser.add_argument('--repeats', type=int, default=10, help="timed runs (median is reported)")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="torch CPU threads")
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--corr_implementation', choices=["reg", "band", "alt", "alt_fast"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    args = parser.parse_args()
+    args.mixed_precision = False
+    main(args)
@@ -0,0 +1,71 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import torch
+from core.raft_stereo import RAFTStereo
+from core.checkpoint import load_model
+from bench_slow_fast import load_samples, run_model, end_point_error
+
+
+def bf16_supported():
+    """ Whether oneDNN has native bfloat16 kernels on this CPU, otherwise bfloat16 is emulated and slower """
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    model = load_model(RAFTStereo(args), args.restore_ckpt)
+    model.eval()
+
+    samples = load_samples(args)
+    has_gt = samples[0][2] is not None
+    print(f"{len(samples)} samples, {args.valid_iters} iterations, {args.corr_implementation} correlation, "
+          f"native bf16: {bf16_supported()}, EPE against {'ground truth' if has_gt else 'float32'}")
+    print("| precision | latency (ms) | speedup | EPE | >1px (%) | max |diff| to float32 |")
+    print("|---|---|---|---|---|---|")
+
+    results = {}
+    for mixed_precision in [False, True]:
+        args.mixed_precision = mixed_precision
+        run_model(model, samples[:1], 1) # warm up the kernels of this precision
+        results[mixed_precision] = run_model(model, samples, args.valid_iters)
+
+    reference_ms, reference = results[False]
+    for mixed_precision, (ms, predictions) in results.items():
+        targets = [s[2] for s in samples] if has_gt else reference
+        valids = [s[3] for s in samples] if has_gt else [None] * len(samples)
+        epe, bad = end_point_error(predictions, targets, valids)
+        diff = max((p - r).abs().max().item() for p, r in zip(predictions, reference))
+        print(f"| {'bfloat16 autocast' if mixed_precision else 'float32'} | {ms:.1f} | {reference_ms / ms:.2f}x | "
+              f"{epe:.4f} | {bad:.3f} | {diff:.4f} |", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restore_ckpt', help="restore checkpoint", required=True)
+    parser.add_argument('--dataset', choices=["eth3d", "kitti", "middlebury_F", "middlebury_H", "middlebury_Q"], default=None,
+                        help="evaluate against ground truth, otherwise the ../python/examples images are compared to float32")
+    parser.add_argument('--max_samples', type=int, default=10, help="number of image pairs")
+    parser.add_argument('--valid_iters', type=int, default=7, help='number of flow-field updates during forward pass')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="torch CPU threads")
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--corr_implementation', choices=["reg", "band", "alt", "alt_fast", "auto"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--corr_memory_budget', type=float, default=1024, help="peak memory budget (MB) of the correlation block for --corr_implementation auto")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (pixels) covered by --corr_implementation band")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    args = parser.parse_args()
+    args.mixed_precision = False
+    main(args)
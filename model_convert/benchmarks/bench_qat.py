@@ -0,0 +1,142 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+import argparse
+import glob
+import numpy as np
+import torch
+from PIL import Image
+from torch.ao.quantization import FakeQuantize, MinMaxObserver, disable_fake_quant, disable_observer, enable_fake_quant, enable_observer
+from checkpoint import load_model
+from core.utils.utils import InputPadder
+from train_qat import FakeQuantConv2d, load_export_model, prepare_qat
+from bench_slow_fast import load_samples, end_point_error
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'python', 'examples')
+
+
+def load_calibration(args):
+    """ Calibration pairs, by default the example images the README packs into calib-left.tar / calib-right.tar """
+    left_images = sorted(glob.glob(args.calib_left_imgs))[:args.calib_samples]
+    right_images = sorted(glob.glob(args.calib_right_imgs))[:args.calib_samples]
+    load = lambda f: torch.from_numpy(np.array(Image.open(f)).astype(np.uint8)[..., :3]).permute(2, 0, 1).float()
+    return [(load(l), load(r)) for l, r in zip(left_images, right_images)]
+
+
+def run_export(model, pairs):
+    """ forward_export (5 iterations, as exported) of every pair, padded to a multiple of 32 """
+    predictions = []
+    with torch.no_grad():
+        for image1, image2 in pairs:
+            padder = InputPadder(image1.shape, divis_by=32)
+            image1, image2 = padder.pad(image1[None], image2[None])
+            predictions.append(padder.unpad(model.forward_export(image1, image2))[0])
+    return predictions
+
+
+def calibrate(model, calibration):
+    """ PTQ: ranges of the float model observed over the calibration pairs with MinMax, as config_r1_qat.json
+
+    The moving averages of the training observers are swapped for plain min/max observers, the weight
+    observers see the same weights every pass and keep theirs.
+    """
+    for module in model.modules():
+        if isinstance(module, FakeQuantize) and module.qscheme == torch.per_tensor_affine:
+            module.activation_post_process = MinMaxObserver(quant_min=0, quant_max=255, dtype=torch.quint8, qscheme=torch.per_tensor_affine)
+    model.eval()
+    model.apply(enable_observer)
+    model.apply(disable_fake_quant)
+    run_export(model, calibration)
+    model.apply(disable_observer)
+    model.apply(enable_fake_quant)
+    return model
+
+
+def activation_fake_quants(model):
+    """ Name and module of every activation fake quantizer: convolution outputs and inputs, the upsampling weights """
+    for name, module in model.named_modules():
+        if isinstance(module, FakeQuantConv2d):
+            yield name, module.output_fake_quant
+            if module.input_fake_quant is not None:
+                yield name + ".input", module.input_fake_quant
+    yield "softmax", model.softmax_fake_quant
+
+
+def layer_sqnr(model, pairs):
+    """ Signal to quantization noise ratio (dB) of each activation fake quantizer over the pairs """
+    signal, noise, hooks = {}, {}, []
+    for name, fake_quant in activation_fake_quants(model):
+        def hook(module, inputs, output, name=name):
+            x = inputs[0].float()
+            signal[name] = signal.get(name, 0.0) + x.pow(2).sum().item()
+            noise[name] = noise.get(name, 0.0) + (output.float() - x).pow(2).sum().item()
+        hooks.append(fake_quant.register_forward_hook(hook))
+    run_export(model, pairs)
+    for h in hooks:
+        h.remove()
+    return {name: 10 * np.log10(signal[name] / max(noise[name], 1e-12)) for name in signal}
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    samples = load_samples(args)
+    pairs = [(s[0], s[1]) for s in samples]
+    has_gt = samples[0][2] is not None
+
+    float_model = load_export_model(args, args.restore_ckpt)[0].eval()
+    ptq_model = calibrate(prepare_qat(load_export_model(args, args.restore_ckpt)[0]), load_calibration(args))
+    qat_model = load_model(prepare_qat(load_export_model(args, args.restore_ckpt)[0]), args.qat_ckpt).eval()
+    qat_model.apply(disable_observer)
+
+    float_predictions = run_export(float_model, pairs)
+    targets = [s[2] for s in samples] if has_gt else float_predictions
+    valids = [s[3] for s in samples] if has_gt else [None] * len(samples)
+    print(f"{len(samples)} samples, forward_export (5 iterations), corr_radius {args.corr_radius}, "
+          f"EPE against {'ground truth' if has_gt else 'the float model'}, INT8 fake quantization in PyTorch")
+    print("| model | EPE | >1px (%) |")
+    print("|---|---|---|")
+    for name, model in (("float", float_model), ("PTQ", ptq_model), ("QAT", qat_model)):
+        predictions = float_predictions if model is float_model else run_export(model, pairs)
+        epe, bad = end_point_error(predictions, targets, valids)
+        print(f"| {name} | {epe:.4f} | {bad:.3f} |", flush=True)
+
+    # the layers PTQ quantizes worst, where QAT has the most to recover
+    ptq_scales = dict(activation_fake_quants(ptq_model))
+    qat_scales = dict(activation_fake_quants(qat_model))
+    ptq_sqnr, qat_sqnr = layer_sqnr(ptq_model, pairs), layer_sqnr(qat_model, pairs)
+    print()
+    print("| layer | PTQ scale | QAT scale | PTQ SQNR (dB) | QAT SQNR (dB) |")
+    print("|---|---|---|---|---|")
+    for name in sorted(ptq_sqnr, key=ptq_sqnr.get)[:args.layers]:
+        print(f"| {name} | {ptq_scales[name].scale.item():.4g} | {qat_scales[name].scale.item():.4g} | "
+              f"{ptq_sqnr[name]:.1f} | {qat_sqnr[name]:.1f} |")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restore_ckpt', help="float checkpoint QAT started from", required=True)
+    parser.add_argument('--qat_ckpt', help="<name>_fq.pth QAT state saved by train_qat.py", required=True)
+    parser.add_argument('--dataset', choices=["eth3d", "kitti", "middlebury_F", "middlebury_H", "middlebury_Q"], default=None,
+                        help="evaluate against ground truth, otherwise the ../python/examples images are compared to the float model")
+    parser.add_argument('--max_samples', type=int, default=10, help="number of image pairs")
+    parser.add_argument('--calib_left_imgs', default=os.path.join(EXAMPLES, "left", "*.png"), help="PTQ calibration first (left) frames")
+    parser.add_argument('--calib_right_imgs', default=os.path.join(EXAMPLES, "right", "*.png"), help="PTQ calibration second (right) frames")
+    parser.add_argument('--calib_samples', type=int, default=32, help="number of PTQ calibration pairs")
+    parser.add_argument('--layers', type=int, default=15, help="number of layers in the per-layer table, worst PTQ SQNR first")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="torch CPU threads")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+
+    # Architecture choices, the committed config_r1_qat.json is the realtime model with radius 1
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--corr_implementation', choices=["reg", "alt", "alt_fast"], default="alt", help="correlation volume implementation, as exported")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=1, choices=[1, 4], help="width of the correlation pyramid, as exported")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    args = parser.parse_args()
+    main(args)
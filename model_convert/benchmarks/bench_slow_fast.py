@@ -0,0 +1,123 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import glob
+import time
+import numpy as np
+import torch
+from PIL import Image
+from core.raft_stereo import RAFTStereo
+from core.checkpoint import load_model
+from core.utils.utils import InputPadder
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'python', 'examples')
+
+
+def parse_schedule(schedule):
+    """ "off", "k" (every k-th iteration) or "k:n" (every k-th of the first n iterations) """
+    if schedule == "off":
+        return dict(slow_fast_gru=False, slow_fast_every=1, slow_fast_iters=None)
+    every, _, first = schedule.partition(":")
+    return dict(slow_fast_gru=True, slow_fast_every=int(every), slow_fast_iters=int(first) if first else None)
+
+
+def load_samples(args):
+    """ (image1, image2, flow_gt, valid_gt) tuples, without ground truth for the example images """
+    if args.dataset is None:
+        left_images = sorted(glob.glob(os.path.join(EXAMPLES, "left", "*.png")))[:args.max_samples]
+        right_images = sorted(glob.glob(os.path.join(EXAMPLES, "right", "*.png")))[:args.max_samples]
+        load = lambda f: torch.from_numpy(np.array(Image.open(f)).astype(np.uint8)[..., :3]).permute(2, 0, 1).float()
+        return [(load(l), load(r), None, None) for l, r in zip(left_images, right_images)]
+
+    # the datasets pull in the training augmentation dependencies
+    import core.stereo_datasets as datasets
+    if args.dataset == 'eth3d':
+        dataset = datasets.ETH3D(aug_params={})
+    elif args.dataset == 'kitti':
+        dataset = datasets.KITTI(aug_params={}, image_set='training')
+    else:
+        dataset = datasets.Middlebury(aug_params={}, split=args.dataset[-1])
+    return [dataset[i][1:] for i in range(min(len(dataset), args.max_samples))]
+
+
+def run_model(model, samples, iters):
+    """ Median latency (ms) and the predictions of the model in its current configuration """
+    predictions, times = [], []
+    with torch.no_grad():
+        for image1, image2, _, _ in samples:
+            padder = InputPadder(image1.shape, divis_by=32)
+            image1, image2 = padder.pad(image1[None], image2[None])
+            t0 = time.perf_counter()
+            _, flow_pr = model(image1, image2, iters=iters, test_mode=True)
+            times.append((time.perf_counter() - t0) * 1000)
+            predictions.append(padder.unpad(flow_pr)[0])
+    return float(np.median(times)), predictions
+
+
+def end_point_error(predictions, targets, valids):
+    epe_list, bad_list = [], []
+    for flow_pr, flow_gt, valid_gt in zip(predictions, targets, valids):
+        epe = (flow_pr - flow_gt).abs()[0].flatten()
+        val = valid_gt.flatten() >= 0.5 if valid_gt is not None else torch.ones_like(epe, dtype=torch.bool)
+        epe_list.append(epe[val].mean().item())
+        bad_list.append((epe[val] > 1.0).float().mean().item())
+    return float(np.mean(epe_list)), float(np.mean(bad_list)) * 100
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    vars(args).update(parse_schedule(args.schedules[0]))
+    model = load_model(RAFTStereo(args), args.restore_ckpt)
+    model.eval()
+
+    samples = load_samples(args)
+    # warm up allocator and kernels before timing
+    with torch.no_grad():
+        image1, image2 = InputPadder(samples[0][0].shape, divis_by=32).pad(samples[0][0][None], samples[0][1][None])
+        model(image1, image2, iters=1, test_mode=True)
+
+    results = {}
+    for schedule in args.schedules:
+        vars(args).update(parse_schedule(schedule))
+        results[schedule] = run_model(model, samples, args.valid_iters)
+
+    reference_ms, reference = results[args.schedules[0]]
+    has_gt = samples[0][2] is not None
+    print(f"{len(samples)} samples, {args.valid_iters} iterations, EPE against "
+          f"{'ground truth' if has_gt else 'schedule ' + args.schedules[0]}")
+    print("| schedule | latency (ms) | speedup | EPE | >1px (%) |")
+    print("|---|---|---|---|---|")
+    for schedule, (ms, predictions) in results.items():
+        targets = [s[2] for s in samples] if has_gt else reference
+        valids = [s[3] for s in samples] if has_gt else [None] * len(samples)
+        epe, bad = end_point_error(predictions, targets, valids)
+        print(f"| {schedule} | {ms:.1f} | {reference_ms / ms:.2f}x | {epe:.3f} | {bad:.2f} |")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restore_ckpt', help="restore checkpoint", required=True)
+    parser.add_argument('--schedules', nargs='+', default=["1", "2", "3", "1:3", "1:1", "off"],
+                        help="slow-fast schedules: off, k (every k-th iteration) or k:n (every k-th of the first n), the first is the reference")
+    parser.add_argument('--dataset', choices=["eth3d", "kitti", "middlebury_F", "middlebury_H", "middlebury_Q"], default=None,
+                        help="evaluate against ground truth, otherwise the ../python/examples images are compared to the first schedule")
+    parser.add_argument('--max_samples', type=int, default=10, help="number of image pairs")
+    parser.add_argument('--valid_iters', type=int, default=7, help='number of flow-field updates during forward pass')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="torch CPU threads")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--corr_implementation', choices=["reg", "band", "alt", "alt_fast", "reg_cuda", "alt_cuda", "auto"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--corr_memory_budget', type=float, default=1024, help="peak memory budget (MB) of the correlation block for --corr_implementation auto")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (pixels) covered by --corr_implementation band")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,19 @@
+import sys
+sys.path.append('core')
+import argparse
+import time
+from checkpoint import convert_checkpoint, load_state_dict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src', help="checkpoint to convert, e.g. the DataParallel .pth files of RAFT-Stereo")
+    parser.add_argument('dst', help="output file, .safetensors (needs safetensors) or .pt for torch.load(mmap=True)")
+    args = parser.parse_args()
+
+    state_dict = convert_checkpoint(args.src, args.dst)
+    print(f"saved {len(state_dict)} tensors ({sum(v.numel() for v in state_dict.values()) / 1e6:.2f}M parameters) to {args.dst}")
+    for path in (args.src, args.dst):
+        t0 = time.perf_counter()
+        load_state_dict(path)
+        print(f"{path}: loaded in {(time.perf_counter() - t0) * 1000:.1f} ms")
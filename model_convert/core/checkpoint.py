@@ -0,0 +1,44 @@
+import torch
+
+try:
+    from safetensors.torch import load_file, save_file
+except ImportError:
+    load_file = save_file = None
+
+PREFIX = 'module.'
+
+
+def strip_prefix(state_dict):
+    """ Parameter names without the 'module.' prefix that torch.nn.DataParallel checkpoints carry """
+    return {k[len(PREFIX):] if k.startswith(PREFIX) else k: v for k, v in state_dict.items()}
+
+
+def load_state_dict(path):
+    """ Flat CPU state dict of a .safetensors file or a torch checkpoint, with or without the DataParallel prefix
+
+    Torch checkpoints are memory-mapped, tensors are paged in from the file as load_state_dict copies them
+    instead of being unpickled into memory first. The original RAFT-Stereo .pth files load as well.
+    """
+    if str(path).endswith('.safetensors'):
+        if load_file is None:
+            raise RuntimeError("safetensors is not installed")
+        return strip_prefix(load_file(path, device='cpu'))
+    return strip_prefix(torch.load(path, map_location='cpu', mmap=True, weights_only=True))
+
+
+def load_model(model, path):
+    """ Load a checkpoint into a bare (not DataParallel) model on the CPU """
+    model.load_state_dict(load_state_dict(path))
+    return model
+
+
+def convert_checkpoint(src, dst):
+    """ Rewrite a checkpoint as a flat, prefix-free .safetensors file or, for any other suffix, a torch file """
+    state_dict = {k: v.contiguous() for k, v in load_state_dict(src).items()}
+    if str(dst).endswith('.safetensors'):
+        if save_file is None:
+            raise RuntimeError("safetensors is not installed")
+        save_file(state_dict, dst)
+    else:
+        torch.save(state_dict, dst)
+    return state_dict
@@ -1,6 +1,7 @@
+import math
 import torch
 import torch.nn.functional as F
-from core.utils.utils import bilinear_sampler
+from core.utils.utils import bilinear_sampler, linear_sampler_1d
 
 try:
     import corr_sampler
@@ -62,12 +63,20 @@ class CorrBlockFast1D:
 
 
 class PytorchAlternateCorrBlock1D:
-    def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4, storage_dtype=None):
         self.num_levels = num_levels
         self.radius = radius
         self.corr_pyramid = []
         self.fmap1 = fmap1
         self.fmap2 = fmap2
+        self.storage_dtype = storage_dtype
+        if storage_dtype is not None:
+            # pool once and keep the fmap2 pyramid channels-last in reduced precision, so a tap is one row
+            self.fmap1_rows = fmap1.permute(0, 2, 3, 1).contiguous()
+            self.fmap2_pyramid = []
+            for i in range(self.num_levels):
+                self.fmap2_pyramid.append(fmap2.permute(0, 2, 3, 1).contiguous().to(storage_dtype))
+                fmap2 = F.avg_pool2d(fmap2, [1, 2], stride=[1, 2])
 
     def corr(self, fmap1, fmap2, coords):
         B, D, H, W = fmap2.shape
@@ -87,6 +96,27 @@ class PytorchAlternateCorrBlock1D:
 
         return corr / torch.sqrt(torch.tensor(D).float())
 
+    def corr_gather(self, fmap1, fmap2, coords):
+        """ corr() for the channels-last reduced-precision fmap2 (B,H,W,D): taps lie on the query row,
+        the two neighbouring columns are gathered as rows, correlated in float32 and interpolated """
+        B, H, W, D = fmap2.shape
+        rows = fmap2.reshape(B*H*W, D)
+        row_start = (torch.arange(B*H, device=fmap2.device) * W).view(B, H, 1)
+        output_corr = []
+        for x in coords[..., 0].unbind(3):
+            x0 = x.floor()
+            w1 = x - x0
+            x0 = x0.long()
+            corr = 0
+            for index, weight in ((x0, 1 - w1), (x0 + 1, w1)):
+                inside = (index >= 0) & (index < W)
+                taps = rows[row_start + index.clamp(0, W - 1)].float()
+                corr = corr + torch.sum(taps * fmap1, dim=-1) * (weight * inside)
+            output_corr.append(corr)
+        corr = torch.stack(output_corr, dim=1).permute(0,2,3,1)
+
+        return corr / torch.sqrt(torch.tensor(D).float())
+
     def __call__(self, coords):
         r = self.radius
         coords = coords.permute(0, 2, 3, 1)
@@ -101,8 +131,11 @@ class PytorchAlternateCorrBlock1D:
             centroid_lvl = coords.reshape(batch, h1, w1, 1, 2).clone()
             centroid_lvl[...,0] = centroid_lvl[...,0] / 2**i
             coords_lvl = centroid_lvl + delta.view(-1, 2)
-            corr = self.corr(fmap1, fmap2, coords_lvl)
-            fmap2 = F.avg_pool2d(fmap2, [1, 2], stride=[1, 2])
+            if self.storage_dtype is not None:
+                corr = self.corr_gather(self.fmap1_rows, self.fmap2_pyramid[i], coords_lvl)
+            else:
+                corr = self.corr(fmap1, fmap2, coords_lvl)
+                fmap2 = F.avg_pool2d(fmap2, [1, 2], stride=[1, 2])
             out_pyramid.append(corr)
         out = torch.cat(out_pyramid, dim=-1)
         return out.permute(0, 3, 1, 2).contiguous().float()
@@ -124,17 +157,21 @@ class PytorchAlternateCorrBlock1DFast(PytorchAlternateCorrBlock1D):
             centroid_lvl = coords.reshape(batch, h1, w1, 1, 2).clone()
             centroid_lvl[...,0] = centroid_lvl[...,0] / 2**i
             coords_lvl = centroid_lvl + delta.view(-1, 2)
-            corr = self.corr(fmap1, fmap2, coords_lvl)
-            fmap2 = F.avg_pool2d(fmap2, [1, 2], stride=[1, 2])
+            if self.storage_dtype is not None:
+                corr = self.corr_gather(self.fmap1_rows, self.fmap2_pyramid[i], coords_lvl)
+            else:
+                corr = self.corr(fmap1, fmap2, coords_lvl)
+                fmap2 = F.avg_pool2d(fmap2, [1, 2], stride=[1, 2])
             out_pyramid.append(corr)
         out = torch.cat(out_pyramid, dim=-1)
         return out.permute(0, 3, 1, 2).contiguous().float()
 
 class CorrBlock1D:
-    def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4, storage_dtype=None):
         self.num_levels = num_levels
         self.radius = radius
         self.corr_pyramid = []
+        self.storage_dtype = storage_dtype
 
         # all pairs correlation
         corr = CorrBlock1D.corr(fmap1, fmap2)
@@ -142,10 +179,10 @@ class CorrBlock1D:
         batch, h1, w1, _, w2 = corr.shape
         corr = corr.reshape(batch*h1*w1, 1, 1, w2)
 
-        self.corr_pyramid.append(corr)
+        self.corr_pyramid.append(corr if storage_dtype is None else corr.to(storage_dtype))
         for i in range(self.num_levels):
             corr = F.avg_pool2d(corr, [1,2], stride=[1,2])
-            self.corr_pyramid.append(corr)
+            self.corr_pyramid.append(corr if storage_dtype is None else corr.to(storage_dtype))
 
     def __call__(self, coords):
         r = self.radius
@@ -158,10 +195,13 @@ class CorrBlock1D:
             dx = torch.linspace(-r, r, 2*r+1)
             dx = dx.view(2*r+1, 1).to(coords.device)
             x0 = dx + coords.reshape(batch*h1*w1, 1, 1, 1) / 2**i
-            y0 = torch.zeros_like(x0)
 
-            coords_lvl = torch.cat([x0,y0], dim=-1)
-            corr = bilinear_sampler(corr, coords_lvl)
+            if self.storage_dtype is not None:
+                corr = linear_sampler_1d(corr.view(batch*h1*w1, -1), x0.view(batch*h1*w1, -1))
+            else:
+                y0 = torch.zeros_like(x0)
+                coords_lvl = torch.cat([x0,y0], dim=-1)
+                corr = bilinear_sampler(corr, coords_lvl)
             corr = corr.view(batch, h1, w1, -1)
             out_pyramid.append(corr)
 
@@ -179,6 +219,83 @@ class CorrBlock1D:
         return corr / torch.sqrt(torch.tensor(D).float())
 
 
+class CorrBlock1DBand:
+    """ CorrBlock1D restricted to disparities in [0, max_disp] (feature map pixels)
+
+    Level i only stores the band of pooled columns j = floor(x/2^i) - ceil(max_disp/2^i) - r + k,
+    k in [0, K), that a lookup of radius r around x - d can reach, so memory is O(H*W*K) instead of
+    O(H*W*W). Lookups inside the band match CorrBlock1D; positions outside it read zero, like
+    positions outside the image.
+    """
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4, max_disp=48, storage_dtype=None):
+        self.num_levels = num_levels
+        self.radius = radius
+        self.corr_pyramid = []
+        self.band_start = []
+        self.storage_dtype = storage_dtype
+
+        B, D, H, W1 = fmap1.shape
+        x = torch.arange(W1, device=fmap1.device)
+        for i in range(self.num_levels):
+            offset = math.ceil(max_disp / 2**i) + radius
+            corr = CorrBlock1DBand.corr(fmap1, fmap2, 2**i, offset, offset + radius + 2)
+            corr = corr.reshape(B*H*W1, 1, 1, -1)
+            self.corr_pyramid.append(corr if storage_dtype is None else corr.to(storage_dtype))
+            self.band_start.append((torch.div(x, 2**i, rounding_mode='floor') - offset).float())
+            fmap2 = F.avg_pool2d(fmap2, [1,2], stride=[1,2])
+
+    def __call__(self, coords):
+        r = self.radius
+        coords = coords[:, :1].permute(0, 2, 3, 1)
+        batch, h1, w1, _ = coords.shape
+
+        out_pyramid = []
+        for i in range(self.num_levels):
+            corr = self.corr_pyramid[i]
+            dx = torch.linspace(-r, r, 2*r+1)
+            dx = dx.view(2*r+1, 1).to(coords.device)
+            # position inside the band of the query column
+            x0 = coords / 2**i - self.band_start[i].view(1, 1, w1, 1)
+            x0 = dx + x0.reshape(batch*h1*w1, 1, 1, 1)
+
+            if self.storage_dtype is not None:
+                corr = linear_sampler_1d(corr.view(batch*h1*w1, -1), x0.view(batch*h1*w1, -1))
+            else:
+                y0 = torch.zeros_like(x0)
+                coords_lvl = torch.cat([x0,y0], dim=-1)
+                corr = bilinear_sampler(corr, coords_lvl)
+            corr = corr.view(batch, h1, w1, -1)
+            out_pyramid.append(corr)
+
+        out = torch.cat(out_pyramid, dim=-1)
+        return out.permute(0, 3, 1, 2).contiguous().float()
+
+    @staticmethod
+    def corr(fmap1, fmap2, scale, offset, band_width):
+        """ (B, H, W1, band_width) correlation of column x of fmap1 with the columns
+        floor(x/scale) - offset + k of fmap2, zero outside fmap2 """
+        B, D, H, W1 = fmap1.shape
+        W2 = fmap2.shape[-1]
+        # tiles of T = Q*scale query columns share a window of Q + band_width - 1 fmap2 columns,
+        # so each tile is one small dense matmul from which the band is gathered
+        Q = band_width
+        T, window = Q * scale, Q + band_width - 1
+        tiles = (W1 + T - 1) // T
+        pad_right = max(0, (tiles - 1) * Q + window - offset - W2)
+        fmap1 = fmap1.permute(0, 2, 3, 1)                                   # B,H,W1,D
+        fmap2 = F.pad(fmap2, [offset, pad_right]).permute(0, 2, 1, 3)       # B,H,D,W2+pad
+
+        m = torch.arange(T, device=fmap1.device).view(T, 1)
+        k = torch.arange(band_width, device=fmap1.device).view(1, band_width)
+        index = torch.div(m, scale, rounding_mode='floor') + k
+
+        band = []
+        for t in range(tiles):
+            dense = torch.matmul(fmap1[:, :, t*T:(t+1)*T], fmap2[..., t*Q:t*Q + window])   # B,H,T,window
+            band.append(dense.gather(-1, index[:dense.shape[2]].expand(B, H, -1, -1)))
+        corr = torch.cat(band, dim=2)
+        return corr / torch.sqrt(torch.tensor(D).float())
+
 class AlternateCorrBlock:
     def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
         raise NotImplementedError
@@ -209,3 +326,58 @@ class AlternateCorrBlock:
         corr = torch.stack(corr_list, dim=1)
         corr = corr.reshape(B, -1, H, W)
         return corr / torch.sqrt(torch.tensor(dim).float())
+
+
+# CPU cost constants fitted with `benchmarks/bench_corr.py --impls reg alt --fit` (float32, 1 thread,
+# median over 256x640 to 544x1920, radius 1/4, 2/4 levels): ns per multiply-add of the all-pairs einsum,
+# ns per sampled tap of a volume lookup and ns per feature channel of an alternate-block tap. Peak memory
+# is counted in live tensors, measured as process RSS (allocator slack included): volumes of the all-pairs
+# correlation for reg, feature maps of fmap2's shape for alt, whose sampled slices add a share per window
+# tap (2r+1). With D=256 features alt only needs less memory than reg for feature maps wider than ~500
+# (radius 1) to ~800 (radius 4) columns.
+REG_VOLUME_NS = 0.054
+REG_LOOKUP_NS = 15.6
+REG_PEAK_VOLUMES = 4.35
+ALT_LOOKUP_NS = 3.96
+ALT_PEAK_FMAPS = 4.77
+ALT_PEAK_FMAPS_PER_TAP = 1.26
+# reg_cuda builds the same volume and samples it with the fused corr_sampler kernel. It can only be
+# benchmarked on a CUDA host, so these are the reg constants with a 10x cheaper lookup: the sampler wins
+# over reg whenever both fit. Re-fit with `bench_corr.py --impls reg reg_cuda alt --fit` on the target GPU.
+REG_CUDA_VOLUME_NS = REG_VOLUME_NS
+REG_CUDA_LOOKUP_NS = REG_LOOKUP_NS / 10
+REG_CUDA_PEAK_VOLUMES = REG_PEAK_VOLUMES
+
+
+def estimate_corr_cost(corr_implementation, shape, num_levels=4, radius=4, iters=12):
+    """ Estimated (peak memory in bytes, time in ms) of building a correlation block for feature maps
+    of shape (B, D, H, W) and indexing it `iters` times """
+    B, D, H, W = shape
+    taps = B * H * W * num_levels * (2*radius + 1)
+    if corr_implementation == "reg":
+        volume = B * H * W * W
+        peak = 4 * volume * REG_PEAK_VOLUMES
+        time_ns = REG_VOLUME_NS * volume * D + iters * REG_LOOKUP_NS * taps
+    elif corr_implementation == "reg_cuda":
+        volume = B * H * W * W
+        peak = 4 * volume * REG_CUDA_PEAK_VOLUMES
+        time_ns = REG_CUDA_VOLUME_NS * volume * D + iters * REG_CUDA_LOOKUP_NS * taps
+    elif corr_implementation == "alt":
+        peak = 4 * B * D * H * W * (ALT_PEAK_FMAPS + ALT_PEAK_FMAPS_PER_TAP * (2*radius + 1))
+        time_ns = iters * ALT_LOOKUP_NS * taps * D
+    else:
+        raise ValueError(f"no cost model for corr_implementation {corr_implementation}")
+    return peak, time_ns / 1e6
+
+
+def select_corr_implementation(shape, num_levels=4, radius=4, iters=12, memory_budget_mb=1024, device='cpu'):
+    """ Fastest correlation implementation whose estimated peak memory fits the budget,
+    or the leanest one if none fits """
+    candidates = ["reg", "alt"]
+    if torch.device(device).type == 'cuda' and 'corr_sampler' in globals():
+        candidates.append("reg_cuda")
+    costs = {impl: estimate_corr_cost(impl, shape, num_levels, radius, iters) for impl in candidates}
+    fitting = [impl for impl in candidates if costs[impl][0] <= memory_budget_mb * 2**20]
+    if fitting:
+        return min(fitting, key=lambda impl: costs[impl][1])
+    return min(candidates, key=lambda impl: costs[impl][0])
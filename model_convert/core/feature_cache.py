@@ -0,0 +1,50 @@
+import hashlib
+from collections import OrderedDict
+import torch
+
+
+def image_key(image):
+    """ Identity of an image tensor by content: sha1 of its shape, dtype and values """
+    h = hashlib.sha1(f"{tuple(image.shape)}{image.dtype}".encode())
+    h.update(image.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """ LRU cache of RAFTStereo.encode_reference outputs for rigs matching one reference against several views
+
+    The first match of a reference runs the context network and feature encoder on it; later matches
+    against other partner images only encode the partner. Entries are keyed by the caller's key (e.g. a
+    camera and frame id) or by image content, and the least recently used entry is dropped beyond max_entries.
+    """
+
+    def __init__(self, model, max_entries=4):
+        self.model = model
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def reference(self, image1, key=None):
+        key = image_key(image1) if key is None else key
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        with torch.no_grad():
+            encoding = self.model.encode_reference(image1)
+        self.entries[key] = encoding
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return encoding
+
+    def match(self, image1, image2, key=None, **kwargs):
+        """ Same outputs as model(image1, image2, test_mode=True, **kwargs) """
+        reference = self.reference(image1, key)
+        with torch.no_grad():
+            return self.model.match(reference, image2, **kwargs)
+
+    def clear(self):
+        self.entries.clear()
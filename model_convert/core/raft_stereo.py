@@ -1,17 +1,19 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from functools import partial
+from torch.utils.checkpoint import checkpoint
 from core.update import BasicMultiUpdateBlock
 from core.extractor import BasicEncoder, MultiBasicEncoder, ResidualBlock
-from core.corr import CorrBlock1D, PytorchAlternateCorrBlock1D,PytorchAlternateCorrBlock1DFast, CorrBlockFast1D, AlternateCorrBlock
-from core.utils.utils import coords_grid, upflow8
+from core.corr import CorrBlock1D, CorrBlock1DBand, PytorchAlternateCorrBlock1D,PytorchAlternateCorrBlock1DFast, CorrBlockFast1D, AlternateCorrBlock, select_corr_implementation
+from core.utils.utils import coords_grid, upflow8, lr_consistency_mask, convex_upsample_points
 
 
 try:
-    autocast = torch.cuda.amp.autocast
+    cuda_autocast = torch.cuda.amp.autocast
 except:
     # dummy autocast for PyTorch < 1.6
-    class autocast:
+    class cuda_autocast:
         def __init__(self, enabled):
             pass
         def __enter__(self):
@@ -19,24 +21,33 @@ except:
         def __exit__(self, *args):
             pass
 
+
+def autocast(enabled, device_type='cuda'):
+    """ Mixed precision on the device of the inputs: float16 on CUDA, bfloat16 on CPU """
+    if not hasattr(torch, 'autocast'): # PyTorch < 1.10 only has the CUDA autocast
+        return cuda_autocast(enabled=enabled and device_type == 'cuda')
+    dtype = torch.bfloat16 if device_type == 'cpu' else torch.float16
+    return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+
 class RAFTStereo(nn.Module):
     def __init__(self, args):
         super().__init__()
         self.args = args
         
         context_dims = args.hidden_dims
+        encoder_dims = getattr(args, 'encoder_dims', [64, 64, 96, 128])
 
-        self.cnet = MultiBasicEncoder(output_dim=[args.hidden_dims, context_dims], norm_fn=args.context_norm, downsample=args.n_downsample)
+        self.cnet = MultiBasicEncoder(output_dim=[args.hidden_dims, context_dims], norm_fn=args.context_norm, downsample=args.n_downsample, dims=encoder_dims)
         self.update_block = BasicMultiUpdateBlock(self.args, hidden_dims=args.hidden_dims)
 
         self.context_zqr_convs = nn.ModuleList([nn.Conv2d(context_dims[i], args.hidden_dims[i]*3, 3, padding=3//2) for i in range(self.args.n_gru_layers)])
 
         if args.shared_backbone:
             self.conv2 = nn.Sequential(
-                ResidualBlock(128, 128, 'instance', stride=1),
-                nn.Conv2d(128, 256, 3, padding=1))
+                ResidualBlock(encoder_dims[3], encoder_dims[3], 'instance', stride=1),
+                nn.Conv2d(encoder_dims[3], 256, 3, padding=1))
         else:
-            self.fnet = BasicEncoder(output_dim=256, norm_fn='instance', downsample=args.n_downsample)
+            self.fnet = BasicEncoder(output_dim=256, norm_fn='instance', downsample=args.n_downsample, dims=encoder_dims)
 
     def freeze_bn(self):
         for m in self.modules():
@@ -67,14 +78,37 @@ class RAFTStereo(nn.Module):
         return up_flow.reshape(N, D, factor*H, factor*W)
 
 
-    def forward(self, image1, image2, iters=12, flow_init=None, test_mode=False):
-        """ Estimate optical flow between pair of frames """
+    def slow_fast_step(self, itr):
+        """ Whether iteration itr runs the extra low-res GRU updates, every k-th of the first n iterations """
+        if not self.args.slow_fast_gru:
+            return False
+        every = getattr(self.args, 'slow_fast_every', 1)
+        first = getattr(self.args, 'slow_fast_iters', None)
+        return itr % every == 0 and (first is None or itr < first)
+
+    def upsample_flow_points(self, flow, mask, points):
+        """ Convex upsampled flow only at full-resolution (x, y) points (B,N,2) -> (B,D,N) """
+        return convex_upsample_points(flow, mask, points, 2 ** self.args.n_downsample)
+
+    def forward(self, image1, image2, iters=12, flow_init=None, test_mode=False, points=None,
+                stop_threshold=None, min_iters=1, stop_percentile=100, flow_gt=None, valid=None, loss_gamma=0.9, max_flow=700):
+        """ Estimate optical flow between pair of frames, in test_mode only at points (B,N,2) if given
+
+        With stop_threshold in test_mode, a sample stops updating once the stop_percentile of its |delta_flow|
+        (1/2^K pixels) falls below the threshold after at least min_iters steps, and iters is the upper bound.
+        The number of steps used per sample (B,) is returned as a third output.
+
+        With flow_gt (B,1,H,W) and valid (B,H,W) outside test_mode, the sequence loss is accumulated inside
+        the loop instead of returning every upsampled prediction: returns (loss, last prediction). With
+        args.checkpoint_updates each iteration is recomputed in the backward pass, so together the peak
+        memory barely grows with iters.
+        """
 
         image1 = (2 * (image1 / 255.0) - 1.0).contiguous()
         image2 = (2 * (image2 / 255.0) - 1.0).contiguous()
         
         # run the context network
-        with autocast(enabled=self.args.mixed_precision):
+        with autocast(self.args.mixed_precision, image1.device.type):
             if self.args.shared_backbone:
                 *cnet_list, x = self.cnet(torch.cat((image1, image2), dim=0), dual_inp=True, num_layers=self.args.n_gru_layers)
                 fmap1, fmap2 = self.conv2(x).split(dim=0, split_size=x.shape[0]//2)
@@ -87,21 +121,72 @@ class RAFTStereo(nn.Module):
             # Rather than running the GRU's conv layers on the context features multiple times, we do it once at the beginning 
             inp_list = [list(conv(i).split(split_size=conv.out_channels//3, dim=1)) for i,conv in zip(inp_list, self.context_zqr_convs)]
 
-        if self.args.corr_implementation == "reg": # Default
+        return self.refine(net_list, inp_list, fmap1, fmap2, iters, flow_init, test_mode, points,
+                           stop_threshold, min_iters, stop_percentile, flow_gt, valid, loss_gamma, max_flow)
+
+    def update_step(self, corr_fn, net_list, inp_list, coords0, coords1, slow_fast):
+        """ Correlation lookup and GRU updates of one iteration -> net_list, up_mask, delta_flow """
+        # the update block replaces the hidden states in place, checkpointing recomputes from the original list
+        net_list = list(net_list)
+        corr = corr_fn(coords1) # index correlation volume
+
+        flow = coords1 - coords0
+        with autocast(self.args.mixed_precision, coords1.device.type):
+            if self.args.n_gru_layers == 3 and slow_fast: # Update low-res GRU
+                net_list = self.update_block(net_list, inp_list, iter32=True, iter16=False, iter08=False, update=False)
+            if self.args.n_gru_layers >= 2 and slow_fast:# Update low-res GRU and mid-res GRU
+                net_list = self.update_block(net_list, inp_list, iter32=self.args.n_gru_layers==3, iter16=True, iter08=False, update=False)
+            net_list, up_mask, delta_flow = self.update_block(net_list, inp_list, corr, flow, iter32=self.args.n_gru_layers==3, iter16=self.args.n_gru_layers>=2)
+
+        # the mask softmax and the flow update stay in float32 under mixed precision
+        delta_flow = delta_flow.float()
+        up_mask = up_mask if up_mask is None else up_mask.float()
+
+        # in stereo mode, project flow onto epipolar
+        delta_flow[:,1] = 0.0
+        return net_list, up_mask, delta_flow
+
+    def loss_step(self, corr_fn, net_list, inp_list, coords0, coords1, slow_fast, flow_gt, valid):
+        """ update_step followed by the L1 loss of the upsampled prediction, so that under checkpointing
+        the full-resolution prediction is only materialized inside the step -> net_list, delta_flow, loss, flow_up """
+        net_list, up_mask, delta_flow = self.update_step(corr_fn, net_list, inp_list, coords0, coords1, slow_fast)
+        flow = coords1 + delta_flow - coords0
+        flow_up = upflow8(flow) if up_mask is None else self.upsample_flow(flow, up_mask)
+        flow_up = flow_up[:,:1]
+        loss = (flow_up - flow_gt).abs()[valid].mean()
+        return net_list, delta_flow, loss, flow_up.detach()
+
+    def refine(self, net_list, inp_list, fmap1, fmap2, iters=12, flow_init=None, test_mode=False, points=None,
+               stop_threshold=None, min_iters=1, stop_percentile=100, flow_gt=None, valid=None, loss_gamma=0.9, max_flow=700):
+        """ Iterative GRU updates from the context features and the feature maps of both images, see forward """
+
+        corr_implementation = self.args.corr_implementation
+        if corr_implementation == "auto": # Pick from the feature map shape and memory budget
+            corr_implementation = select_corr_implementation(fmap1.shape, self.args.corr_levels, self.args.corr_radius, iters,
+                                                             getattr(self.args, 'corr_memory_budget', 1024), fmap1.device)
+
+        if corr_implementation == "reg": # Default
             corr_block = CorrBlock1D
             fmap1, fmap2 = fmap1.float(), fmap2.float()
-        elif self.args.corr_implementation == "alt": # More memory efficient than reg
+        elif corr_implementation == "band": # reg restricted to disparities in [0, max_disp]
+            corr_block = partial(CorrBlock1DBand, max_disp=getattr(self.args, 'max_disp', 192) / 2**self.args.n_downsample)
+            fmap1, fmap2 = fmap1.float(), fmap2.float()
+        elif corr_implementation == "alt": # More memory efficient than reg
             corr_block = PytorchAlternateCorrBlock1D
             fmap1, fmap2 = fmap1.float(), fmap2.float()
-        elif self.args.corr_implementation =="alt_fast":
+        elif corr_implementation =="alt_fast":
             corr_block = PytorchAlternateCorrBlock1DFast
             fmap1, fmap2 = fmap1.float(), fmap2.float()
-        elif self.args.corr_implementation == "reg_cuda": # Faster version of reg
+        elif corr_implementation == "reg_cuda": # Faster version of reg
             corr_block = CorrBlockFast1D
-        elif self.args.corr_implementation == "alt_cuda": # Faster version of alt
+        elif corr_implementation == "alt_cuda": # Faster version of alt
             corr_block = AlternateCorrBlock
 
-        
+        corr_dtype = getattr(self.args, 'corr_dtype', 'float32')
+        if corr_dtype != 'float32' and corr_implementation in ("reg", "band", "alt", "alt_fast"):
+            # store the pyramid (or the alt fmap2 pyramid) in reduced precision, lookups accumulate in float32
+            corr_block = partial(corr_block, storage_dtype=getattr(torch, corr_dtype))
+
         corr_fn = corr_block(fmap1, fmap2, radius=self.args.corr_radius, num_levels=self.args.corr_levels)
 
         coords0, coords1 = self.initialize_flow(net_list[0])
@@ -109,43 +194,120 @@ class RAFTStereo(nn.Module):
         if flow_init is not None:
             coords1 = coords1 + flow_init
 
+        adaptive = test_mode and stop_threshold is not None
+        if adaptive:
+            active = torch.ones(coords1.shape[0], dtype=torch.bool, device=coords1.device)
+            iters_used = torch.full_like(active, iters, dtype=torch.long)
+            final_mask = None
+
+        streaming = flow_gt is not None and not test_mode
+        if streaming:
+            valid = (valid >= 0.5).unsqueeze(1) & (flow_gt.abs() < max_flow)
+            # same weights as sequence_loss: gamma adjusted to the number of iterations
+            gamma = loss_gamma**(15/(iters - 1)) if iters > 1 else loss_gamma
+            loss = 0.0
+
+        if getattr(self.args, 'checkpoint_updates', False) and self.training and torch.is_grad_enabled():
+            run_step = partial(checkpoint, use_reentrant=False)
+        else:
+            run_step = lambda step, *args: step(*args)
+
         flow_predictions = []
         for itr in range(iters):
             coords1 = coords1.detach()
-            corr = corr_fn(coords1) # index correlation volume
-            
-            flow = coords1 - coords0
-            with autocast(enabled=self.args.mixed_precision):
-                if self.args.n_gru_layers == 3 and self.args.slow_fast_gru: # Update low-res GRU
-                    net_list = self.update_block(net_list, inp_list, iter32=True, iter16=False, iter08=False, update=False)
-                if self.args.n_gru_layers >= 2 and self.args.slow_fast_gru:# Update low-res GRU and mid-res GRU
-                    net_list = self.update_block(net_list, inp_list, iter32=self.args.n_gru_layers==3, iter16=True, iter08=False, update=False)
-                net_list, up_mask, delta_flow = self.update_block(net_list, inp_list, corr, flow, iter32=self.args.n_gru_layers==3, iter16=self.args.n_gru_layers>=2)
-
-            # in stereo mode, project flow onto epipolar
-            delta_flow[:,1] = 0.0
+            slow_fast = self.slow_fast_step(itr)
+            step_args = (corr_fn, net_list, inp_list, coords0, coords1, slow_fast)
+            if streaming:
+                net_list, delta_flow, step_loss, flow_up = run_step(self.loss_step, *step_args, flow_gt, valid)
+                loss = loss + gamma ** (iters - itr - 1) * step_loss
+                coords1 = coords1 + delta_flow
+                continue
+            net_list, up_mask, delta_flow = run_step(self.update_step, *step_args)
+
+            converged = False
+            if adaptive:
+                # stopped samples keep their flow and the upsampling mask of their last step
+                delta_flow = delta_flow * active.view(-1, 1, 1, 1)
+                if up_mask is not None:
+                    final_mask = up_mask if final_mask is None else torch.where(active.view(-1, 1, 1, 1), up_mask, final_mask)
+                    up_mask = final_mask
+                magnitude = delta_flow[:,0].abs().flatten(1).float()
+                if stop_percentile >= 100:
+                    magnitude = magnitude.amax(dim=1)
+                else:
+                    magnitude = torch.quantile(magnitude, stop_percentile / 100, dim=1)
+                stopped = active & (magnitude < stop_threshold) & (itr + 1 >= min_iters)
+                iters_used = torch.where(stopped, torch.full_like(iters_used, itr + 1), iters_used)
+                active = active & ~stopped
+                converged = not active.any()
 
             # F(t+1) = F(t) + \Delta(t)
             coords1 = coords1 + delta_flow
 
             # We do not need to upsample or output intermediate results in test_mode
-            if test_mode and itr < iters-1:
+            if test_mode and itr < iters-1 and not converged:
                 continue
 
             # upsample predictions
-            if up_mask is None:
+            if test_mode and points is not None:
+                flow_up = self.upsample_flow_points(coords1 - coords0, up_mask, points)
+            elif up_mask is None:
                 flow_up = upflow8(coords1 - coords0)
             else:
                 flow_up = self.upsample_flow(coords1 - coords0, up_mask)
             flow_up = flow_up[:,:1]
 
             flow_predictions.append(flow_up)
+            if converged:
+                break
+
+        if streaming:
+            return loss, flow_up
+
+        if adaptive:
+            return coords1 - coords0, flow_up, iters_used
 
         if test_mode:
             return coords1 - coords0, flow_up
 
         return flow_predictions
 
+    def encode_reference(self, image1):
+        """ Context features and feature map of a reference image, matched against partner images with match """
+        image1 = (2 * (image1 / 255.0) - 1.0).contiguous()
+
+        with autocast(self.args.mixed_precision, image1.device.type):
+            if self.args.shared_backbone:
+                x = self.cnet.trunk(image1)
+                cnet_list = self.cnet.heads(x, num_layers=self.args.n_gru_layers)
+                fmap1 = self.conv2(x)
+            else:
+                cnet_list = self.cnet(image1, num_layers=self.args.n_gru_layers)
+                fmap1 = self.fnet(image1)
+            net_list = [torch.tanh(x[0]) for x in cnet_list]
+            inp_list = [torch.relu(x[1]) for x in cnet_list]
+            inp_list = [list(conv(i).split(split_size=conv.out_channels//3, dim=1)) for i,conv in zip(inp_list, self.context_zqr_convs)]
+
+        return dict(net_list=net_list, inp_list=inp_list, fmap1=fmap1)
+
+    def encode_partner(self, image2):
+        """ Feature map of a partner image, the context network is only run on the reference """
+        image2 = (2 * (image2 / 255.0) - 1.0).contiguous()
+
+        with autocast(self.args.mixed_precision, image2.device.type):
+            if self.args.shared_backbone:
+                return self.conv2(self.cnet.trunk(image2))
+            return self.fnet(image2)
+
+    def match(self, reference, image2, iters=12, flow_init=None, points=None,
+              stop_threshold=None, min_iters=1, stop_percentile=100):
+        """ forward(image1, image2, test_mode=True) with the encode_reference(image1) output, so a reference
+        matched against several partner images is encoded once. Same outputs as forward in test_mode """
+        fmap2 = self.encode_partner(image2)
+        # the update block replaces the hidden states in place, keep the cached list intact
+        return self.refine(list(reference['net_list']), reference['inp_list'], reference['fmap1'], fmap2, iters, flow_init,
+                           True, points, stop_threshold, min_iters, stop_percentile)
+
     def forward_export(self, image1, image2, ):
         """ Estimate optical flow between pair of frames """
 
@@ -155,8 +317,8 @@ class RAFTStereo(nn.Module):
         image1 = (2 * (image1 / 255.0) - 1.0).contiguous()
         image2 = (2 * (image2 / 255.0) - 1.0).contiguous()
         
-        # run the context network
-        with autocast(enabled=self.args.mixed_precision):
+        # run the context network, the exported graph stays float32 whatever mixed_precision is: Pulsar2 quantizes from float32
+        with autocast(False, image1.device.type):
             if self.args.shared_backbone:
                 *cnet_list, x = self.cnet(torch.cat((image1, image2), dim=0), dual_inp=True, num_layers=self.args.n_gru_layers)
                 fmap1, fmap2 = self.conv2(x).split(dim=0, split_size=x.shape[0]//2)
@@ -169,18 +331,26 @@ class RAFTStereo(nn.Module):
             # Rather than running the GRU's conv layers on the context features multiple times, we do it once at the beginning 
             inp_list = [list(conv(i).split(split_size=conv.out_channels//3, dim=1)) for i,conv in zip(inp_list, self.context_zqr_convs)]
 
-        if self.args.corr_implementation == "reg": # Default
+        corr_implementation = self.args.corr_implementation
+        if corr_implementation == "auto": # Pick from the feature map shape and memory budget
+            corr_implementation = select_corr_implementation(fmap1.shape, self.args.corr_levels, self.args.corr_radius, iters,
+                                                             getattr(self.args, 'corr_memory_budget', 1024), fmap1.device)
+
+        if corr_implementation == "reg": # Default
             corr_block = CorrBlock1D
             fmap1, fmap2 = fmap1.float(), fmap2.float()
-        elif self.args.corr_implementation == "alt": # More memory efficient than reg
+        elif corr_implementation == "band": # reg restricted to disparities in [0, max_disp]
+            corr_block = partial(CorrBlock1DBand, max_disp=getattr(self.args, 'max_disp', 192) / 2**self.args.n_downsample)
+            fmap1, fmap2 = fmap1.float(), fmap2.float()
+        elif corr_implementation == "alt": # More memory efficient than reg
             corr_block = PytorchAlternateCorrBlock1D
             fmap1, fmap2 = fmap1.float(), fmap2.float()
-        elif self.args.corr_implementation =="alt_fast":
+        elif corr_implementation =="alt_fast":
             corr_block = PytorchAlternateCorrBlock1DFast
             fmap1, fmap2 = fmap1.float(), fmap2.float()
-        elif self.args.corr_implementation == "reg_cuda": # Faster version of reg
+        elif corr_implementation == "reg_cuda": # Faster version of reg
             corr_block = CorrBlockFast1D
-        elif self.args.corr_implementation == "alt_cuda": # Faster version of alt
+        elif corr_implementation == "alt_cuda": # Faster version of alt
             corr_block = AlternateCorrBlock
 
         
@@ -196,10 +366,11 @@ class RAFTStereo(nn.Module):
             coords1 = coords1.detach()
             corr = corr_fn(coords1) # index correlation volume
             flow = coords1 - coords0
-            with autocast(enabled=self.args.mixed_precision):
-                if self.args.n_gru_layers == 3 and self.args.slow_fast_gru: # Update low-res GRU
+            slow_fast = self.slow_fast_step(itr)
+            with autocast(False, image1.device.type):
+                if self.args.n_gru_layers == 3 and slow_fast: # Update low-res GRU
                     net_list = self.update_block(net_list, inp_list, iter32=True, iter16=False, iter08=False, update=False)
-                if self.args.n_gru_layers >= 2 and self.args.slow_fast_gru:# Update low-res GRU and mid-res GRU
+                if self.args.n_gru_layers >= 2 and slow_fast:# Update low-res GRU and mid-res GRU
                     net_list = self.update_block(net_list, inp_list, iter32=self.args.n_gru_layers==3, iter16=True, iter08=False, update=False)
                 net_list, up_mask, delta_flow = self.update_block(net_list, inp_list, corr, flow, iter32=self.args.n_gru_layers==3, iter16=self.args.n_gru_layers>=2)
 
@@ -213,6 +384,10 @@ class RAFTStereo(nn.Module):
             if test_mode and itr < iters-1:
                 continue
 
+            # leave the convex upsampling to the host: low-res flow and mask logits
+            if getattr(self.args, 'lowres_output', False):
+                return (coords1 - coords0)[:,:1], up_mask
+
             # upsample predictions
             if up_mask is None:
                 flow_up = upflow8(coords1 - coords0)
@@ -226,3 +401,24 @@ class RAFTStereo(nn.Module):
             return  flow_up
 
         return flow_predictions
+
+    def forward_lr(self, image1, image2, iters=12, threshold=1.0):
+        """ Estimate the left flow and a left-right consistency mask in a single batch of 2 """
+        B = image1.shape[0]
+        # the right view is matched as a mirrored stereo pair: (flip(right), flip(left))
+        left = torch.cat([image1, image2.flip(-1)], dim=0)
+        right = torch.cat([image2, image1.flip(-1)], dim=0)
+        _, flow_up = self.forward(left, right, iters=iters, test_mode=True)
+        flow_left, flow_right = flow_up[:B], flow_up[B:].flip(-1)
+        valid = lr_consistency_mask(-flow_left, -flow_right, threshold)
+        return flow_left, valid
+
+    def forward_export_lr(self, image1, image2, ):
+        """ forward_export with a left-right consistency mask as second output """
+        B = image1.shape[0]
+        left = torch.cat([image1, image2.flip(-1)], dim=0)
+        right = torch.cat([image2, image1.flip(-1)], dim=0)
+        flow_up = self.forward_export(left, right)
+        flow_left, flow_right = flow_up[:B], flow_up[B:].flip(-1)
+        valid = lr_consistency_mask(-flow_left, -flow_right, getattr(self.args, 'lr_threshold', 1.0))
+        return flow_left, valid
@@ -279,6 +279,43 @@ class Middlebury(StereoDataset):
                 self.image_list += [ [img1, img2] ]
                 self.disparity_list += [ disp ]
 
+
+class UnlabeledStereo(StereoDataset):
+    """ Rectified stereo pairs without ground truth, e.g. recordings of the target rig used for distillation """
+    def __init__(self, left_imgs, right_imgs, crop_size=None):
+        super().__init__()
+        self.crop_size = crop_size
+        image1_list = sorted(glob(left_imgs, recursive=True))
+        image2_list = sorted(glob(right_imgs, recursive=True))
+        assert len(image1_list) == len(image2_list) > 0, [left_imgs, right_imgs]
+        for img1, img2 in zip(image1_list, image2_list):
+            self.image_list += [ [img1, img2] ]
+
+    def __getitem__(self, index):
+        img1 = np.array(frame_utils.read_gen(self.image_list[index][0])).astype(np.uint8)
+        img2 = np.array(frame_utils.read_gen(self.image_list[index][1])).astype(np.uint8)
+
+        # grayscale images
+        if len(img1.shape) == 2:
+            img1 = np.tile(img1[...,None], (1, 1, 3))
+            img2 = np.tile(img2[...,None], (1, 1, 3))
+        else:
+            img1 = img1[..., :3]
+            img2 = img2[..., :3]
+
+        if self.crop_size is not None:
+            # the same window in both views keeps the pair rectified
+            ht, wd = img1.shape[:2]
+            assert ht >= self.crop_size[0] and wd >= self.crop_size[1], (self.image_list[index], self.crop_size)
+            y0 = np.random.randint(0, ht - self.crop_size[0] + 1)
+            x0 = np.random.randint(0, wd - self.crop_size[1] + 1)
+            img1 = img1[y0:y0+self.crop_size[0], x0:x0+self.crop_size[1]]
+            img2 = img2[y0:y0+self.crop_size[0], x0:x0+self.crop_size[1]]
+
+        img1 = torch.from_numpy(np.ascontiguousarray(img1)).permute(2, 0, 1).float()
+        img2 = torch.from_numpy(np.ascontiguousarray(img2)).permute(2, 0, 1).float()
+        return self.image_list[index], img1, img2
+
   
 def fetch_dataloader(args):
     """ Create the data loader for the corresponding trainign set """
@@ -25,7 +25,77 @@ class InputPadder:
         c = [self._pad[2], ht-self._pad[3], self._pad[0], wd-self._pad[1]]
         return x[..., c[0]:c[1], c[2]:c[3]]
 
-def forward_interpolate(flow):
+def forward_interpolate(flow, splat='nearest', resolve='zbuffer', method='splat'):
+    """ Warp a flow field (2,H,W) or (B,2,H,W) forward along itself, e.g. as flow_init for the next frame
+
+    method='splat' stays on the device of flow: every pixel is splatted to the nearest target pixel, or
+    to its 4 neighbours with bilinear weights (splat='bilinear'). Targets hit more than once keep the
+    samples with the largest |flow|, the closest surface in stereo (resolve='zbuffer'), or the weighted
+    average of all of them (resolve='average'). Holes take the nearest splatted value along their row,
+    rows without any hit that of the nearest row. method='griddata' is the scipy implementation.
+    """
+    if method == 'griddata':
+        return _forward_interpolate_griddata(flow).to(flow.device)
+
+    batched = flow.ndim == 4
+    flow = flow.detach().float()
+    flow = flow if batched else flow[None]
+    B, D, H, W = flow.shape
+    device = flow.device
+
+    ys, xs = torch.meshgrid(torch.arange(H, device=device), torch.arange(W, device=device), indexing='ij')
+    x1, y1 = xs + flow[:, 0], ys + flow[:, 1]
+    if splat == 'nearest':
+        corners = [(x1.round(), y1.round(), torch.ones_like(x1))]
+    else:
+        x0, y0 = x1.floor(), y1.floor()
+        wx, wy = x1 - x0, y1 - y0
+        corners = [(x0, y0, (1 - wx) * (1 - wy)), (x0 + 1, y0, wx * (1 - wy)),
+                   (x0, y0 + 1, (1 - wx) * wy), (x0 + 1, y0 + 1, wx * wy)]
+
+    # one (target, source, weight) contribution per splatted corner, flattened over the batch
+    source = torch.arange(B * H * W, device=device).view(B, H, W)
+    offset = (torch.arange(B, device=device) * H * W).view(B, 1, 1)
+    targets, sources, weights = [], [], []
+    for cx, cy, weight in corners:
+        inside = (cx >= 0) & (cx <= W - 1) & (cy >= 0) & (cy <= H - 1) & (weight > 0)
+        target = offset + cy.clamp(0, H - 1).long() * W + cx.clamp(0, W - 1).long()
+        targets.append(target[inside])
+        sources.append(source[inside])
+        weights.append(weight[inside])
+    target, source, weight = torch.cat(targets), torch.cat(sources), torch.cat(weights)
+
+    values = flow.permute(0, 2, 3, 1).reshape(B * H * W, D)
+    if resolve == 'zbuffer':
+        depth = flow.norm(dim=1).reshape(-1)[source]
+        nearest = torch.full((B * H * W,), -float('inf'), device=device).scatter_reduce(0, target, depth, 'amax')
+        front = depth >= nearest[target]
+        target, source, weight = target[front], source[front], weight[front]
+
+    total = torch.zeros(B * H * W, device=device).index_add_(0, target, weight)
+    warped = torch.zeros(B * H * W, D, device=device).index_add_(0, target, values[source] * weight[:, None])
+    warped = (warped / total.clamp(min=1e-6)[:, None]).view(B, H, W, D).permute(0, 3, 1, 2)
+    hit = (total > 0).view(B, 1, H, W)
+
+    warped = _fill_nearest(warped, hit, dim=3)
+    warped = _fill_nearest(warped, hit.any(dim=3, keepdim=True).expand_as(hit), dim=2)
+    return warped if batched else warped[0]
+
+
+def _fill_nearest(x, valid, dim):
+    """ Replace the invalid entries of x with the nearest valid entry along dim, zero if there is none """
+    n = x.shape[dim]
+    shape = [1] * x.ndim
+    shape[dim] = n
+    pos = torch.arange(n, device=x.device).view(shape)
+    before = torch.where(valid, pos, -1).cummax(dim).values
+    after = torch.where(valid, pos, n).flip(dim).cummin(dim).values.flip(dim)
+    nearest = torch.where((after < n) & ((before < 0) | (after - pos < pos - before)), after, before)
+    filled = x.gather(dim, nearest.clamp(0, n - 1).expand_as(x))
+    return torch.where(nearest >= 0, filled, torch.zeros_like(filled))
+
+
+def _forward_interpolate_griddata(flow):
     flow = flow.detach().cpu().numpy()
     dx, dy = flow[0], flow[1]
 
@@ -74,6 +144,33 @@ def bilinear_sampler(img, coords, mode='bilinear', mask=False):
     return img
 
 
+def linear_sampler_1d(volume, x):
+    """ Linear interpolation of volume (..., W) at pixel positions x (..., K) along the last dim with
+    zero padding, like bilinear_sampler on a single row; the taps are gathered in the storage dtype
+    and accumulated in float32 """
+    W = volume.shape[-1]
+    x0 = x.floor()
+    w1 = x - x0
+    x0 = x0.long()
+    out = 0
+    for index, weight in ((x0, 1 - w1), (x0 + 1, w1)):
+        inside = (index >= 0) & (index < W)
+        out = out + volume.gather(-1, index.clamp(0, W - 1)).float() * (weight * inside)
+    return out
+
+
+def lr_consistency_mask(disp_left, disp_right, threshold=1.0):
+    """ Valid where the left disparity agrees with the right disparity it points at (B,1,H,W) """
+    B, _, H, W = disp_left.shape
+    xs = torch.arange(W, device=disp_left.device, dtype=disp_left.dtype).view(1, 1, 1, W)
+    ys = torch.arange(H, device=disp_left.device, dtype=disp_left.dtype).view(1, 1, H, 1)
+    x_right = xs - disp_left
+    coords = torch.cat([x_right, ys.expand(B, 1, H, W)], dim=1).permute(0, 2, 3, 1)
+    disp_warped = bilinear_sampler(disp_right, coords)
+    valid = ((disp_left - disp_warped).abs() < threshold) & (x_right >= 0)
+    return valid.float()
+
+
 def coords_grid(batch, ht, wd):
     coords = torch.meshgrid(torch.arange(ht), torch.arange(wd))
     coords = torch.stack(coords[::-1], dim=0).float()
@@ -84,6 +181,55 @@ def upflow8(flow, mode='bilinear'):
     new_size = (8 * flow.shape[2], 8 * flow.shape[3])
     return  8 * F.interpolate(flow, size=new_size, mode=mode, align_corners=True)
 
+def convex_upsample_points(flow, mask, points, factor):
+    """ Convex upsampling of flow (B,D,H,W) with mask logits (B,9*factor^2,H,W) evaluated only at the
+    full-resolution pixels points (B,N,2) given as (x, y), rounded to the nearest pixel -> (B,D,N) """
+    B, D, H, W = flow.shape
+    points = points.round().long()
+    x = points[..., 0].clamp(0, factor * W - 1)
+    y = points[..., 1].clamp(0, factor * H - 1)
+    h, i = y // factor, y % factor
+    w, j = x // factor, x % factor
+    b = torch.arange(B, device=flow.device).view(B, 1)
+
+    # softmax over the 9 neighbours of each point only, (B, N, 9)
+    mask = mask.view(B, 9, factor * factor, H, W).permute(0, 2, 3, 4, 1)
+    weights = torch.softmax(mask[b, i * factor + j, h, w].float(), dim=-1)
+
+    # 3x3 neighbourhood of the enclosing low-res cell, zero padded like F.unfold, (B, N, 9, D)
+    ky, kx = torch.meshgrid(torch.arange(3, device=flow.device), torch.arange(3, device=flow.device), indexing='ij')
+    flow = F.pad(factor * flow, [1, 1, 1, 1]).permute(0, 2, 3, 1)
+    neighbors = flow[b[..., None], h[..., None] + ky.reshape(-1), w[..., None] + kx.reshape(-1)]
+
+    return (weights[..., None] * neighbors).sum(dim=2).permute(0, 2, 1)
+
+
+def sequence_loss(flow_preds, flow_gt, valid, loss_gamma=0.9, max_flow=700):
+    """ Exponentially weighted L1 loss over all flow predictions (B,1,H,W), the later the heavier
+
+    RAFTStereo.forward(..., flow_gt=flow_gt, valid=valid) accumulates the same loss without keeping the predictions.
+    """
+    n_predictions = len(flow_preds)
+    valid = (valid >= 0.5).unsqueeze(1) & (flow_gt.abs() < max_flow)
+    # gamma adjusted to the number of iterations
+    gamma = loss_gamma**(15/(n_predictions - 1)) if n_predictions > 1 else loss_gamma
+    flow_loss = 0.0
+    for i, flow_pr in enumerate(flow_preds):
+        flow_loss += gamma**(n_predictions - i - 1) * (flow_pr - flow_gt).abs()[valid].mean()
+    return flow_loss, flow_metrics(flow_preds[-1], flow_gt, valid)
+
+
+def flow_metrics(flow_pr, flow_gt, valid):
+    """ EPE and the fraction of pixels within 1, 3 and 5 pixels over the valid mask """
+    epe = (flow_pr - flow_gt).abs().detach()[valid.expand_as(flow_gt)]
+    return {
+        'epe': epe.mean().item(),
+        '1px': (epe < 1).float().mean().item(),
+        '3px': (epe < 3).float().mean().item(),
+        '5px': (epe < 5).float().mean().item(),
+    }
+
+
 def gauss_blur(input, N=5, std=1):
     B, D, H, W = input.shape
     x, y = torch.meshgrid(torch.arange(N).float() - N//2, torch.arange(N).float() - N//2)
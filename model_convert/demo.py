@@ -0,0 +1,95 @@
+import sys
+sys.path.append('core')
+import argparse
+import glob
+from pathlib import Path
+import numpy as np
+import torch
+from PIL import Image
+from matplotlib import pyplot as plt
+from raft_stereo import RAFTStereo
+from checkpoint import load_model
+from core.utils.utils import InputPadder
+
+
+def load_image(imfile, device):
+    img = np.array(Image.open(imfile)).astype(np.uint8)[..., :3]
+    img = torch.from_numpy(img).permute(2, 0, 1).float()
+    return img[None].to(device)
+
+
+def demo(args):
+    model = load_model(RAFTStereo(args), args.restore_ckpt)
+    model.to(args.device)
+    model.eval()
+
+    output_directory = Path(args.output_directory)
+    output_directory.mkdir(exist_ok=True)
+
+    with torch.no_grad():
+        left_images = sorted(glob.glob(args.left_imgs, recursive=True))
+        right_images = sorted(glob.glob(args.right_imgs, recursive=True))
+        print(f"Found {len(left_images)} images. Saving files to {output_directory}/")
+
+        for (imfile1, imfile2) in zip(left_images, right_images):
+            image1 = load_image(imfile1, args.device)
+            image2 = load_image(imfile2, args.device)
+
+            padder = InputPadder(image1.shape, divis_by=32)
+            image1, image2 = padder.pad(image1, image2)
+
+            if args.lr_consistency:
+                flow_up, valid = model.forward_lr(image1, image2, iters=args.valid_iters, threshold=args.lr_threshold)
+                valid = padder.unpad(valid).cpu().numpy().squeeze()
+            elif args.stop_threshold is not None:
+                _, flow_up, iters_used = model(image1, image2, iters=args.valid_iters, test_mode=True, stop_threshold=args.stop_threshold,
+                                               min_iters=args.min_iters, stop_percentile=args.stop_percentile)
+                print(f"{Path(imfile1).name}: converged after {iters_used.item()} iterations")
+            else:
+                _, flow_up = model(image1, image2, iters=args.valid_iters, test_mode=True)
+            disp = -padder.unpad(flow_up).cpu().numpy().squeeze()
+
+            file_stem = Path(imfile1).stem
+            if args.lr_consistency:
+                plt.imsave(output_directory / f"{file_stem}_valid.png", valid, cmap='gray')
+                disp = np.where(valid > 0, disp, 0)
+            if args.save_numpy:
+                np.save(output_directory / f"{file_stem}.npy", disp)
+            plt.imsave(output_directory / f"{file_stem}.png", disp, cmap='jet')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restore_ckpt', help="restore checkpoint", required=True)
+    parser.add_argument('--save_numpy', action='store_true', help='save output as numpy arrays')
+    parser.add_argument('-l', '--left_imgs', help="path to all first (left) frames", default="../python/examples/left/*.png")
+    parser.add_argument('-r', '--right_imgs', help="path to all second (right) frames", default="../python/examples/right/*.png")
+    parser.add_argument('--output_directory', help="directory to save output", default="demo_output")
+    parser.add_argument('--device', default="cpu", help="torch device to run on")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+    parser.add_argument('--valid_iters', type=int, default=32, help='number of flow-field updates during forward pass')
+    parser.add_argument('--stop_threshold', type=float, default=None, help="stop iterating once the update magnitude (1/2^K pixels) falls below this, --valid_iters is the upper bound")
+    parser.add_argument('--stop_percentile', type=float, default=100, help="percentile of the per-pixel update magnitude compared to --stop_threshold (100 = max)")
+    parser.add_argument('--min_iters', type=int, default=1, help="minimum number of flow-field updates with --stop_threshold")
+    parser.add_argument('--lr_consistency', action='store_true', help="estimate both views as a batch of 2 and mask left-right inconsistent pixels")
+    parser.add_argument('--lr_threshold', type=float, default=1.0, help="max left-right disparity difference (pixels) for a valid pixel")
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--encoder_dims', nargs=4, type=int, default=[64, 64, 96, 128], help="channels of the encoder stem and residual stages")
+    parser.add_argument('--corr_implementation', choices=["reg", "band", "alt", "alt_fast", "reg_cuda", "alt_cuda", "auto"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--corr_memory_budget', type=float, default=1024, help="peak memory budget (MB) of the correlation block for --corr_implementation auto")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (pixels) covered by --corr_implementation band")
+    parser.add_argument('--corr_dtype', choices=["float32", "float16", "bfloat16"], default="float32", help="storage dtype of the correlation pyramid (reg, band) or the fmap2 pyramid (alt), lookups accumulate in float32")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+    parser.add_argument('--slow_fast_every', type=int, default=1, help="with --slow_fast_gru, run the extra low-res GRU updates only every k-th iteration")
+    parser.add_argument('--slow_fast_iters', type=int, default=None, help="with --slow_fast_gru, run the extra low-res GRU updates only in the first n iterations")
+
+    args = parser.parse_args()
+    demo(args)
@@ -0,0 +1,182 @@
+import sys
+sys.path.append('core')
+import argparse
+import copy
+import glob
+import os
+import logging
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from PIL import Image
+from raft_stereo import RAFTStereo
+from checkpoint import load_model
+from core.utils.utils import InputPadder, flow_metrics
+import core.stereo_datasets as datasets
+
+
+def student_args(args):
+    """ Teacher architecture with the student's GRU and encoder widths """
+    student = copy.copy(args)
+    student.hidden_dims = args.student_hidden_dims
+    student.encoder_dims = args.student_encoder_dims
+    return student
+
+
+def init_from_teacher(student, teacher):
+    """ Copy the teacher weights of every student tensor with the same shape (flow head, motion encoder, ...) """
+    teacher_state = teacher.state_dict()
+    state = student.state_dict()
+    shared = {k: v for k, v in teacher_state.items() if k in state and state[k].shape == v.shape}
+    student.load_state_dict(shared, strict=False)
+    return len(shared), len(state)
+
+
+@torch.no_grad()
+def teacher_targets(teacher, image1, image2, args):
+    """ Teacher disparities used as ground truth, pixels failing the left-right check are left out """
+    if args.lr_threshold > 0:
+        flow, valid = teacher.forward_lr(image1, image2, iters=args.teacher_iters, threshold=args.lr_threshold)
+        return flow, valid[:, 0]
+    _, flow = teacher(image1, image2, iters=args.teacher_iters, test_mode=True)
+    return flow, torch.ones_like(flow[:, 0])
+
+
+def load_image(imfile):
+    img = np.array(Image.open(imfile)).astype(np.uint8)[..., :3]
+    return torch.from_numpy(img).permute(2, 0, 1).float()[None]
+
+
+@torch.no_grad()
+def compare(teacher, student, args):
+    """ CPU latency of the exported forward_export graph and the student's error against the teacher's output """
+    left_images = sorted(glob.glob(args.val_left_imgs, recursive=True))[:args.val_samples]
+    right_images = sorted(glob.glob(args.val_right_imgs, recursive=True))[:args.val_samples]
+    teacher.eval()
+    student.eval()
+
+    times = {"teacher": [], "student": []}
+    epe_list, bad_list = [], []
+    for imfile1, imfile2 in zip(left_images, right_images):
+        image1, image2 = load_image(imfile1), load_image(imfile2)
+        padder = InputPadder(image1.shape, divis_by=32)
+        image1, image2 = padder.pad(image1, image2)
+        outputs = {}
+        for name, model in (("teacher", teacher), ("student", student)):
+            t0 = time.perf_counter()
+            outputs[name] = padder.unpad(model.forward_export(image1, image2))
+            times[name].append((time.perf_counter() - t0) * 1000)
+        metrics = flow_metrics(outputs["student"], outputs["teacher"], torch.ones_like(outputs["teacher"], dtype=torch.bool))
+        epe_list.append(metrics['epe'])
+        bad_list.append(1 - metrics['1px'])
+
+    teacher_ms, student_ms = np.median(times["teacher"]), np.median(times["student"])
+    count = lambda model: sum(p.numel() for p in model.parameters()) / 1e6
+    print(f"{len(epe_list)} pairs, forward_export ({args.n_downsample} downsample, 5 iterations), errors against the teacher")
+    print("| model | params (M) | latency (ms) | speedup | EPE | >1px (%) |")
+    print("|---|---|---|---|---|---|")
+    print(f"| teacher | {count(teacher):.2f} | {teacher_ms:.1f} | 1.00x | 0.000 | 0.00 |")
+    print(f"| student | {count(student):.2f} | {student_ms:.1f} | {teacher_ms / student_ms:.2f}x | "
+          f"{np.mean(epe_list):.3f} | {100 * np.mean(bad_list):.2f} |")
+
+
+def train(args):
+    teacher = load_model(RAFTStereo(args), args.teacher_ckpt)
+    teacher.eval()
+    student = RAFTStereo(student_args(args))
+    if args.restore_ckpt is not None:
+        load_model(student, args.restore_ckpt)
+    else:
+        shared, total = init_from_teacher(student, teacher)
+        logging.info(f"initialized {shared}/{total} student tensors from the teacher")
+    student.train()
+
+    dataset = datasets.UnlabeledStereo(args.left_imgs, args.right_imgs, crop_size=args.image_size)
+    held_out = {os.path.realpath(f) for pattern in (args.val_left_imgs, args.val_right_imgs) for f in glob.glob(pattern, recursive=True)}
+    overlap = held_out & {os.path.realpath(f) for pair in dataset.image_list for f in pair}
+    assert not overlap, f"{len(overlap)} held-out images are also distillation images, e.g. {sorted(overlap)[0]}"
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=True)
+    logging.info('Distilling on %d image pairs' % len(dataset))
+
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr, weight_decay=args.wdecay, eps=1e-8)
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, args.lr, args.num_steps + 100, pct_start=0.01,
+                                                    cycle_momentum=False, anneal_strategy='linear')
+
+    Path(args.output_directory).mkdir(exist_ok=True, parents=True)
+    total_steps = 0
+    while total_steps < args.num_steps:
+        for _, image1, image2 in train_loader:
+            flow, valid = teacher_targets(teacher, image1, image2, args)
+            optimizer.zero_grad()
+            loss, flow_up = student(image1, image2, iters=args.train_iters, flow_gt=flow, valid=valid)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            total_steps += 1
+
+            if total_steps % args.log_freq == 0:
+                metrics = flow_metrics(flow_up, flow, (valid >= 0.5).unsqueeze(1))
+                logging.info(f"step {total_steps}: loss {loss.item():.4f}, " + ", ".join(f"{k} {v:.4f}" for k, v in metrics.items()))
+            if total_steps % args.save_freq == 0:
+                torch.save(torch.nn.DataParallel(student).state_dict(), Path(args.output_directory) / f"{total_steps}_{args.name}.pth")
+            if total_steps >= args.num_steps:
+                break
+
+    path = Path(args.output_directory) / f"{args.name}.pth"
+    torch.save(torch.nn.DataParallel(student).state_dict(), path)
+    logging.info(f"saved {path}")
+    compare(teacher, student, args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default='raft-stereo-student', help="name of the student checkpoint")
+    parser.add_argument('--teacher_ckpt', help="teacher checkpoint", required=True)
+    parser.add_argument('--restore_ckpt', default=None, help="resume the student from this checkpoint, otherwise it is initialized from the teacher where shapes match")
+    parser.add_argument('--compare_only', action='store_true', help="only report latency and EPE of --restore_ckpt relative to the teacher")
+    parser.add_argument('--output_directory', help="directory to save checkpoints", default="checkpoints")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+    parser.add_argument('-l', '--left_imgs', help="unlabeled first (left) frames", default="../python/examples/left/*.png")
+    parser.add_argument('-r', '--right_imgs', help="unlabeled second (right) frames", default="../python/examples/right/*.png")
+    parser.add_argument('--val_left_imgs', help="held-out first (left) frames for the report, disjoint from --left_imgs", required=True)
+    parser.add_argument('--val_right_imgs', help="held-out second (right) frames for the report, disjoint from --right_imgs", required=True)
+    parser.add_argument('--val_samples', type=int, default=10, help="number of held-out pairs in the report")
+
+    # Training parameters
+    parser.add_argument('--batch_size', type=int, default=2, help="batch size used during training.")
+    parser.add_argument('--num_workers', type=int, default=2, help="data loading workers")
+    parser.add_argument('--lr', type=float, default=2e-4, help="max learning rate.")
+    parser.add_argument('--num_steps', type=int, default=20000, help="length of training schedule.")
+    parser.add_argument('--image_size', type=int, nargs='+', default=[256, 640], help="size of the random image crops used during training.")
+    parser.add_argument('--train_iters', type=int, default=5, help="number of student updates in each forward pass, forward_export runs 5")
+    parser.add_argument('--teacher_iters', type=int, default=32, help="number of teacher updates for the distillation targets")
+    parser.add_argument('--lr_threshold', type=float, default=1.0, help="drop teacher disparities failing the left-right check by more than this (pixels), 0 keeps all")
+    parser.add_argument('--wdecay', type=float, default=.00001, help="Weight decay in optimizer.")
+    parser.add_argument('--log_freq', type=int, default=100, help="steps between training logs")
+    parser.add_argument('--save_freq', type=int, default=5000, help="steps between checkpoints")
+    parser.add_argument('--checkpoint_updates', action='store_true', help="recompute each update iteration in the backward pass to save memory")
+
+    # Architecture choices, shared by teacher and student except for the widths
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="teacher hidden state and context dimensions")
+    parser.add_argument('--encoder_dims', nargs=4, type=int, default=[64, 64, 96, 128], help="teacher channels of the encoder stem and residual stages")
+    parser.add_argument('--student_hidden_dims', nargs='+', type=int, default=[64]*3, help="student hidden state and context dimensions")
+    parser.add_argument('--student_encoder_dims', nargs=4, type=int, default=[32, 32, 48, 64], help="student channels of the encoder stem and residual stages")
+    parser.add_argument('--corr_implementation', choices=["reg", "alt", "alt_fast"], default="alt", help="correlation volume implementation")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    args = parser.parse_args()
+    torch.manual_seed(1234)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
+    if args.compare_only:
+        assert args.restore_ckpt is not None, "--compare_only needs the student --restore_ckpt"
+        compare(load_model(RAFTStereo(args), args.teacher_ckpt), load_model(RAFTStereo(student_args(args)), args.restore_ckpt), args)
+    else:
+        train(args)
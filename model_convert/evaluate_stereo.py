@@ -0,0 +1,127 @@
+import sys
+import os
+sys.path.append('core')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import argparse
+import time
+from collections import defaultdict
+import numpy as np
+import torch
+from PIL import Image
+from raft_stereo import RAFTStereo
+from checkpoint import load_model
+from core.utils.utils import InputPadder
+import core.stereo_datasets as datasets
+from disparity_cache import open_cache
+
+# disparity error (pixels) above which a pixel counts as an outlier in the D1 metric
+OUTLIER_THRESHOLDS = {"eth3d": 1.0, "kitti": 3.0, "middlebury": 2.0}
+
+
+def load_dataset(name):
+    if name == 'eth3d':
+        return datasets.ETH3D(aug_params={})
+    if name == 'kitti':
+        return datasets.KITTI(aug_params={}, image_set='training')
+    return datasets.Middlebury(aug_params={}, split=name[-1])
+
+
+def make_batches(dataset, bucket_size, batch_size):
+    """ Batches of dataset indices whose images pad to the same multiple of bucket_size
+
+    Image sizes are read from the file headers, so the images are only decoded once, when their batch runs.
+    """
+    buckets = defaultdict(list)
+    for index, (left, _) in enumerate(dataset.image_list):
+        W, H = Image.open(left).size
+        buckets[(-(-H // bucket_size) * bucket_size, -(-W // bucket_size) * bucket_size)].append(index)
+    return [indices[i:i + batch_size] for _, indices in sorted(buckets.items()) for i in range(0, len(indices), batch_size)]
+
+
+def run_batch(model, samples, args):
+    """ One forward pass over samples padded to their common bucket shape, unpadded flow per sample """
+    padders = [InputPadder(image1.shape, divis_by=args.bucket_size) for _, image1, _, _, _ in samples]
+    image1 = torch.cat([p.pad(s[1][None])[0] for p, s in zip(padders, samples)]).to(args.device)
+    image2 = torch.cat([p.pad(s[2][None])[0] for p, s in zip(padders, samples)]).to(args.device)
+    _, flow_pr = model(image1, image2, iters=args.valid_iters, test_mode=True)
+    return [p.unpad(flow[None])[0, 0].cpu().numpy() for p, flow in zip(padders, flow_pr)]
+
+
+@torch.no_grad()
+def validate(model, name, args, cache=None):
+    """ EPE and D1 (% outliers) of a benchmark, evaluated in batches of same-shape samples """
+    model.eval()
+    dataset = load_dataset(name)
+    threshold = OUTLIER_THRESHOLDS[name.split('_')[0]]
+    batches = make_batches(dataset, args.bucket_size, args.batch_size)
+    loader = torch.utils.data.DataLoader(dataset, batch_sampler=batches, num_workers=args.num_workers, collate_fn=list)
+    params = {k: v for k, v in sorted(vars(args).items()) if k not in ("dataset", "batch_size", "num_workers", "device", "cache_dir", "cache_size_mb")}
+
+    epe_list, out_list, model_time, hits = [], [], 0.0, 0
+    for samples in loader:
+        keys = [cache.key(args.restore_ckpt, *s[0][:2], **params) for s in samples] if cache is not None else [None] * len(samples)
+        flows = [cache.get(key) if key is not None else None for key in keys]
+        misses = [i for i, flow in enumerate(flows) if flow is None]
+        hits += len(samples) - len(misses)
+        if misses:
+            t0 = time.perf_counter()
+            for i, flow in zip(misses, run_batch(model, [samples[i] for i in misses], args)):
+                flows[i] = flow
+                if cache is not None:
+                    cache.put(keys[i], flow)
+            model_time += time.perf_counter() - t0
+
+        for (_, _, _, flow_gt, valid_gt), flow_pr in zip(samples, flows):
+            epe = np.abs(flow_pr - flow_gt[0].numpy()).flatten()
+            val = (valid_gt.numpy().flatten() >= 0.5) & (flow_gt[0].numpy().flatten() > -1000)
+            epe_list.append(epe[val].mean())
+            out_list.append(epe[val] > threshold)
+
+    epe = float(np.mean(epe_list))
+    d1 = 100 * float(np.mean(np.concatenate(out_list)))
+    throughput = f"{(len(dataset) - hits) / model_time:.2f} pairs/s" if model_time > 0 else "no model runs"
+    print(f"Validation {name}: EPE {epe:.4f}, D1 {d1:.3f}, {len(batches)} batches, {throughput}"
+          + (f", {hits} cached" if cache is not None else ""))
+    return {f'{name}-epe': epe, f'{name}-d1': d1}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restore_ckpt', help="restore checkpoint", required=True)
+    parser.add_argument('--dataset', nargs='+', choices=["eth3d", "kitti", "middlebury_F", "middlebury_H", "middlebury_Q"], default=["eth3d"], help="benchmarks to evaluate")
+    parser.add_argument('--batch_size', type=int, default=4, help="max samples per forward pass, samples are only batched with others of the same padded shape")
+    parser.add_argument('--bucket_size', type=int, default=32, help="images are padded to a multiple of this (a multiple of 32), larger values merge more shapes into one bucket at the cost of padding")
+    parser.add_argument('--num_workers', type=int, default=2, help="data loading workers")
+    parser.add_argument('--device', default="cpu", help="torch device to run on")
+    parser.add_argument('--cache_dir', default=None, help="reuse predictions of unchanged (checkpoint, images, settings) from this disparity cache")
+    parser.add_argument('--cache_size_mb', type=float, default=512, help="disparity cache size bound")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+    parser.add_argument('--valid_iters', type=int, default=32, help='number of flow-field updates during forward pass')
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--encoder_dims', nargs=4, type=int, default=[64, 64, 96, 128], help="channels of the encoder stem and residual stages")
+    parser.add_argument('--corr_implementation', choices=["reg", "band", "alt", "alt_fast", "reg_cuda", "alt_cuda", "auto"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--corr_memory_budget', type=float, default=1024, help="peak memory budget (MB) of the correlation block for --corr_implementation auto")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (pixels) covered by --corr_implementation band")
+    parser.add_argument('--corr_dtype', choices=["float32", "float16", "bfloat16"], default="float32", help="storage dtype of the correlation pyramid (reg, band) or the fmap2 pyramid (alt), lookups accumulate in float32")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+    parser.add_argument('--slow_fast_every', type=int, default=1, help="with --slow_fast_gru, run the extra low-res GRU updates only every k-th iteration")
+    parser.add_argument('--slow_fast_iters', type=int, default=None, help="with --slow_fast_gru, run the extra low-res GRU updates only in the first n iterations")
+
+    args = parser.parse_args()
+    assert args.bucket_size % 32 == 0, "--bucket_size must be a multiple of 32"
+
+    model = load_model(RAFTStereo(args), args.restore_ckpt)
+    model.to(args.device)
+
+    # float32 storage, a cached rerun reports exactly the EPE and D1 of an uncached run
+    cache = open_cache(args.cache_dir, args.cache_size_mb, dtype=np.float32)
+    for name in args.dataset:
+        validate(model, name, args, cache)
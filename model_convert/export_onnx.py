@@ -7,16 +7,38 @@ import numpy as np
 import torch
 from torch import nn
 from raft_stereo import RAFTStereo
+from checkpoint import load_model
+from build_cache import BuildCache, build_key
 import onnx
 from onnx.shape_inference import infer_shapes
 import onnxsim
 
 def export(args):
-    model = torch.nn.DataParallel(RAFTStereo(args), device_ids=[0])
-    model.load_state_dict(torch.load(args.restore_ckpt))
-    
+    output_directory = args.output_directory
+    os.makedirs(output_directory, exist_ok=True)
+
+    height = args.height
+    width = args.width
+
+    if args.lowres_output:
+        assert not args.lr_consistency, "--lowres_output cannot be combined with --lr_consistency"
+        suffix = "_lowres"
+        output_names = ["flow_lowres", "mask"]
+    else:
+        suffix = "_lr" if args.lr_consistency else ""
+        output_names = ["output", "valid"] if args.lr_consistency else ["output"]
+    onnx_path = f"{output_directory}/raft_steoro{height}x{width}_r{args.corr_radius}{suffix}.onnx"
+
+    # an unchanged checkpoint, set of options, core/ source and toolchain gives the same ONNX model
+    options = {k: v for k, v in sorted(vars(args).items()) if k not in ("restore_ckpt", "output_directory", "build_cache", "rebuild")}
+    key, manifest = build_key(args.restore_ckpt, options, sources=[__file__])
+    cache = BuildCache(args.build_cache if args.build_cache is not None else os.path.join(output_directory, ".build_cache"))
+    if not args.rebuild and cache.get(key, onnx_path):
+        print("unchanged export reused from build cache {}, model saved in {}".format(key[:12], onnx_path))
+        return
+
+    model = load_model(RAFTStereo(args), args.restore_ckpt)
     device = torch.device("cpu")
-    model = model.module
 
     if args.corr_radius == 1:
         print("update_block encoder convc1", model.update_block.encoder.convc1.weight.data.shape)
@@ -33,14 +55,7 @@ def export(args):
 
     model.to(device)
     model.eval()
-    model.forward = model.forward_export
-
-    output_directory = args.output_directory
-    os.makedirs(output_directory, exist_ok=True)
-
-    
-    height = args.height
-    width = args.width
+    model.forward = model.forward_export_lr if args.lr_consistency else model.forward_export
 
     x1 = torch.rand((1,3,height,width)).to(device)
     x2 = torch.rand((1,3,height,width)).to(device)
@@ -48,15 +63,18 @@ def export(args):
     input = (x1,x2)
     input_names=["x1","x2"]
 
-    onnx_path = f"{output_directory}/raft_steoro{height}x{width}_r{args.corr_radius}.onnx"
-    torch.onnx.export(model, input, onnx_path, input_names=input_names, output_names=["output"], opset_version=16)
+    torch.onnx.export(model, input, onnx_path, input_names=input_names, output_names=output_names, opset_version=16)
     onnx_model = onnx.load(onnx_path)
     onnx_model = infer_shapes(onnx_model)
     # convert model
     model_simp, check = onnxsim.simplify(onnx_model)
     assert check, "Simplified ONNX model could not be validated"
-    onnx.save(model_simp, onnx_path)
+    # weights inline: the build cache stores the .onnx file only, the exporter's external-data sidecar is stale now
+    onnx.save(model_simp, onnx_path, save_as_external_data=False)
+    if os.path.exists(onnx_path + ".data"):
+        os.remove(onnx_path + ".data")
     print("onnx simpilfy successed, and model saved in {}".format(onnx_path))
+    cache.put(key, onnx_path, manifest)
 
 
 if __name__ == '__main__':
@@ -68,7 +86,10 @@ if __name__ == '__main__':
 
     # Architecture choices
     parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
-    parser.add_argument('--corr_implementation', choices=["reg", "alt", "alt_fast", "reg_cuda", "alt_cuda"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--encoder_dims', nargs=4, type=int, default=[64, 64, 96, 128], help="channels of the encoder stem and residual stages")
+    parser.add_argument('--corr_implementation', choices=["reg", "band", "alt", "alt_fast", "reg_cuda", "alt_cuda", "auto"], default="reg", help="correlation volume implementation")
+    parser.add_argument('--corr_memory_budget', type=float, default=1024, help="peak memory budget (MB) of the correlation block for --corr_implementation auto")
+    parser.add_argument('--max_disp', type=int, default=192, help="maximum disparity (pixels) covered by --corr_implementation band")
     parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
     parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
     parser.add_argument('--corr_radius', type=int, default=4, help="width of the correlation pyramid")
@@ -76,8 +97,15 @@ if __name__ == '__main__':
     parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
     parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
     parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+    parser.add_argument('--slow_fast_every', type=int, default=1, help="with --slow_fast_gru, run the extra low-res GRU updates only every k-th iteration")
+    parser.add_argument('--slow_fast_iters', type=int, default=None, help="with --slow_fast_gru, run the extra low-res GRU updates only in the first n iterations")
     parser.add_argument('--width', type=int, required=True, help="image width input to model")
     parser.add_argument('--height', type=int, required=True, help="image height input to model")
+    parser.add_argument('--lr_consistency', action='store_true', help="run left and right views as a batch of 2 and add a consistency mask output")
+    parser.add_argument('--lowres_output', action='store_true', help="output the 1/2^K flow and the upsampling mask logits, convex upsampling is left to the host")
+    parser.add_argument('--lr_threshold', type=float, default=1.0, help="max left-right disparity difference (pixels at model resolution) for a valid pixel")
+    parser.add_argument('--build_cache', default=None, help="directory of previously exported models, reused when checkpoint, options, core/ source and versions are unchanged (default <output_directory>/.build_cache)")
+    parser.add_argument('--rebuild', action='store_true', help="export even if the build cache has this variant")
 
     args = parser.parse_args()
     export(args)        
\ No newline at end of file
@@ -0,0 +1,37 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import core.corr as corr
+from core.corr import estimate_corr_cost, select_corr_implementation
+
+# feature maps of a 384x1280 image at 1/8 resolution, and of a very wide (panoramic) image at 1/4 resolution
+SHAPE = (1, 256, 48, 160)
+WIDE = (1, 256, 64, 2048)
+
+
+def test_reg_when_it_fits():
+    assert select_corr_implementation(SHAPE, memory_budget_mb=1024) == "reg"
+
+
+def test_alt_above_the_budget():
+    reg_peak, _ = estimate_corr_cost("reg", WIDE)
+    alt_peak, _ = estimate_corr_cost("alt", WIDE)
+    assert alt_peak < reg_peak
+    budget_mb = (alt_peak + reg_peak) / 2 / 2**20
+    assert select_corr_implementation(WIDE, memory_budget_mb=budget_mb) == "alt"
+    assert select_corr_implementation(WIDE, memory_budget_mb=2 * reg_peak / 2**20) == "reg"
+
+
+def test_leanest_when_nothing_fits():
+    assert select_corr_implementation(WIDE, memory_budget_mb=0) == "alt"
+    assert select_corr_implementation(SHAPE, memory_budget_mb=0) == "reg"
+
+
+def test_reg_cuda_on_cuda_when_available(monkeypatch):
+    monkeypatch.setattr(corr, "corr_sampler", object(), raising=False)
+    assert select_corr_implementation(SHAPE, memory_budget_mb=1024, device="cuda") == "reg_cuda"
+
+
+def test_no_reg_cuda_without_the_extension(monkeypatch):
+    monkeypatch.delattr(corr, "corr_sampler", raising=False)
+    assert select_corr_implementation(SHAPE, memory_budget_mb=1024, device="cuda") != "reg_cuda"
@@ -0,0 +1,244 @@
+import sys
+sys.path.append('core')
+import argparse
+import copy
+import logging
+import types
+from pathlib import Path
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import FakeQuantize, MovingAverageMinMaxObserver, MovingAveragePerChannelMinMaxObserver, disable_observer
+import onnx
+from onnx.shape_inference import infer_shapes
+import onnxsim
+from raft_stereo import RAFTStereo
+from checkpoint import load_model
+from core.utils.utils import flow_metrics
+import core.stereo_datasets as datasets
+
+# INT8 scheme of the NPU: per-tensor asymmetric U8 activations, per-channel symmetric S8 weights
+activation_fake_quant = FakeQuantize.with_args(observer=MovingAverageMinMaxObserver, quant_min=0, quant_max=255,
+                                               dtype=torch.quint8, qscheme=torch.per_tensor_affine)
+weight_fake_quant = FakeQuantize.with_args(observer=MovingAveragePerChannelMinMaxObserver, quant_min=-128, quant_max=127,
+                                           dtype=torch.qint8, qscheme=torch.per_channel_symmetric, ch_axis=0)
+
+# correlation taps kept by export_onnx.py for --corr_radius 1: the centre 3 of the 9 taps of each level
+RADIUS1_TAPS = [slice(3 + 9 * level, 6 + 9 * level) for level in range(4)]
+
+
+class FakeQuantConv2d(nn.Module):
+    """ Conv2d with fake-quantized weights and output, and optionally input, as the NPU runs it in INT8 """
+    def __init__(self, conv, quantize_input=False):
+        super().__init__()
+        self.conv = conv
+        self.out_channels = conv.out_channels
+        self.weight_fake_quant = weight_fake_quant()
+        self.output_fake_quant = activation_fake_quant()
+        self.input_fake_quant = activation_fake_quant() if quantize_input else None
+
+    def forward(self, x):
+        if self.input_fake_quant is not None:
+            x = self.input_fake_quant(x)
+        return self.output_fake_quant(self.conv._conv_forward(x, self.weight_fake_quant(self.conv.weight), self.conv.bias))
+
+
+def upsample_flow_fake_quant(self, flow, mask):
+    """ RAFTStereo.upsample_flow with INT8 convex combination weights """
+    N, D, H, W = flow.shape
+    factor = 2 ** self.args.n_downsample
+    mask = mask.view(N, 1, 9, factor, factor, H, W)
+    mask = self.softmax_fake_quant(torch.softmax(mask, dim=2))
+
+    up_flow = F.unfold(factor * flow, [3,3], padding=1)
+    up_flow = up_flow.view(N, D, 9, 1, 1, H, W)
+
+    up_flow = torch.sum(mask * up_flow, dim=2)
+    up_flow = up_flow.permute(0, 1, 4, 2, 5, 3)
+    return up_flow.reshape(N, D, factor*H, factor*W)
+
+
+def prepare_qat(model):
+    """ Fake-quantize every convolution, the correlation features entering convc1 and the upsampling weights.
+
+    The coordinate and flow arithmetic (lookup coordinates, flow updates, upsampled flow) is left in float:
+    it needs sub-pixel resolution over the whole image width and stays U16 in config_r1_qat.json.
+    """
+    for name, module in list(model.named_modules()):
+        for child_name, child in module.named_children():
+            if isinstance(child, nn.Conv2d):
+                setattr(module, child_name, FakeQuantConv2d(child, quantize_input=child is model.update_block.encoder.convc1))
+    model.softmax_fake_quant = activation_fake_quant()
+    model.upsample_flow = types.MethodType(upsample_flow_fake_quant, model)
+    return model
+
+
+def strip_fake_quant(model):
+    """ Back to a plain RAFTStereo with the fine-tuned float weights, the learned scales and zero points are dropped """
+    for name, module in list(model.named_modules()):
+        for child_name, child in module.named_children():
+            if isinstance(child, FakeQuantConv2d):
+                setattr(module, child_name, child.conv)
+    del model.softmax_fake_quant
+    del model.upsample_flow
+    return model
+
+
+def narrow_convc1(model):
+    """ Same convc1 reduction as export_onnx.py for --corr_radius 1, the 36-channel original is returned """
+    convc1 = model.update_block.encoder.convc1
+    narrow = nn.Conv2d(4 * 3, convc1.out_channels, 1, padding=0)
+    narrow.weight.data = torch.cat([convc1.weight.data[:, taps] for taps in RADIUS1_TAPS], dim=1)
+    narrow.bias.data = convc1.bias.data.clone()
+    model.update_block.encoder.convc1 = narrow
+    return convc1
+
+
+def widen_convc1(model, original):
+    """ Write the fine-tuned radius 1 taps back into the 36-channel convc1 that export_onnx.py expects """
+    narrow = model.update_block.encoder.convc1
+    for i, taps in enumerate(RADIUS1_TAPS):
+        original.weight.data[:, taps] = narrow.weight.data[:, 3 * i:3 * i + 3]
+    original.bias.data = narrow.bias.data.clone()
+    model.update_block.encoder.convc1 = original
+
+
+def load_export_model(args, path):
+    """ Float model as export_onnx.py builds it, with convc1 reduced to the radius 1 taps for --corr_radius 1
+
+    Returns the model and the original 36-channel convc1, None for radius 4.
+    """
+    model = load_model(RAFTStereo(args), path)
+    original_convc1 = narrow_convc1(model) if args.corr_radius == 1 else None
+    return model, original_convc1
+
+
+def fake_quant_path(path):
+    """ <name>_fq.pth next to the float checkpoint <name>.pth """
+    path = Path(path)
+    return path.with_name(f"{path.stem}_fq{path.suffix}")
+
+
+def save_checkpoint(model, original_convc1, path):
+    """ Float checkpoint in the DataParallel layout loaded by export_onnx.py, and the QAT state with the learned
+    scales and zero points in <name>_fq.pth for export_qdq and benchmarks/bench_qat.py """
+    torch.save(model.state_dict(), fake_quant_path(path))
+    model = strip_fake_quant(copy.deepcopy(model))
+    if original_convc1 is not None:
+        widen_convc1(model, copy.deepcopy(original_convc1))
+    torch.save(nn.DataParallel(model).state_dict(), path)
+
+
+def export_qdq(model, args, output_directory):
+    """ ONNX of forward_export at --image_size with a QuantizeLinear/DequantizeLinear pair per fake-quantized tensor
+
+    The pairs carry the learned scales and zero points, per-channel S8 for the weights and U8 for the activations,
+    so Pulsar2 uses the trained ranges rather than recalibrating those tensors. The other tensors (the U16 layers of
+    config_r1_qat.json) are calibrated as usual.
+    """
+    model = copy.deepcopy(model).eval()
+    model.apply(disable_observer)
+    model.forward = model.forward_export
+    height, width = args.image_size
+    x1 = torch.rand((1, 3, height, width)) * 255
+    x2 = torch.rand((1, 3, height, width)) * 255
+
+    onnx_path = f"{output_directory}/raft_steoro{height}x{width}_r{args.corr_radius}_qdq.onnx"
+    # the fake-quantize ops become QDQ pairs with the TorchScript exporter, torch.export does not trace them
+    torch.onnx.export(model, (x1, x2), onnx_path, input_names=["x1", "x2"], output_names=["output"], opset_version=16, dynamo=False)
+    model_simp, check = onnxsim.simplify(infer_shapes(onnx.load(onnx_path)))
+    assert check, "Simplified ONNX model could not be validated"
+    onnx.save(model_simp, onnx_path, save_as_external_data=False)
+    quantized = sum(node.op_type == "QuantizeLinear" for node in model_simp.graph.node)
+    logging.info(f"saved {onnx_path} with {quantized} QuantizeLinear/DequantizeLinear pairs")
+    return onnx_path
+
+
+def train(args):
+    model, original_convc1 = load_export_model(args, args.restore_ckpt)
+    prepare_qat(model)
+    model.train()
+    model.freeze_bn() # keep the BatchNorm statistics, they are folded into the convolutions on the NPU
+
+    train_loader = datasets.fetch_dataloader(args)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wdecay, eps=1e-8)
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, args.lr, args.num_steps + 100, pct_start=0.01,
+                                                    cycle_momentum=False, anneal_strategy='linear')
+
+    Path(args.output_directory).mkdir(exist_ok=True, parents=True)
+    total_steps = 0
+    while total_steps < args.num_steps:
+        for _, image1, image2, flow, valid in train_loader:
+            optimizer.zero_grad()
+            loss, flow_up = model(image1, image2, iters=args.train_iters, flow_gt=flow, valid=valid)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            total_steps += 1
+
+            if total_steps == args.freeze_observer_step:
+                # fine-tune the last steps against fixed quantization ranges
+                model.apply(disable_observer)
+            if total_steps % args.log_freq == 0:
+                metrics = flow_metrics(flow_up, flow, (valid >= 0.5).unsqueeze(1) & (flow.abs() < 700))
+                logging.info(f"step {total_steps}: loss {loss.item():.4f}, " + ", ".join(f"{k} {v:.4f}" for k, v in metrics.items()))
+            if total_steps % args.save_freq == 0:
+                save_checkpoint(model, original_convc1, Path(args.output_directory) / f"{total_steps}_{args.name}.pth")
+            if total_steps >= args.num_steps:
+                break
+
+    path = Path(args.output_directory) / f"{args.name}.pth"
+    save_checkpoint(model, original_convc1, path)
+    logging.info(f"saved {path} and {fake_quant_path(path)}")
+    export_qdq(model, args, args.output_directory)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default='raft-stereo-qat', help="name of the fine-tuned checkpoint")
+    parser.add_argument('--restore_ckpt', help="restore checkpoint", required=True)
+    parser.add_argument('--qat_ckpt', default=None, help="only export the QDQ model of this <name>_fq.pth QAT state, --restore_ckpt is the float checkpoint it was trained from")
+    parser.add_argument('--output_directory', help="directory to save checkpoints and the QDQ model", default="checkpoints")
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+
+    # Training parameters
+    parser.add_argument('--batch_size', type=int, default=2, help="batch size used during training.")
+    parser.add_argument('--train_datasets', nargs='+', default=['sceneflow'], help="training datasets.")
+    parser.add_argument('--lr', type=float, default=1e-5, help="max learning rate, small for fine-tuning")
+    parser.add_argument('--num_steps', type=int, default=5000, help="length of training schedule.")
+    parser.add_argument('--freeze_observer_step', type=int, default=4000, help="step after which the quantization ranges are fixed")
+    parser.add_argument('--image_size', type=int, nargs='+', default=[256, 640], help="size of the random image crops used during training, the export resolution")
+    parser.add_argument('--train_iters', type=int, default=5, help="number of updates to the disparity field in each forward pass, forward_export runs 5")
+    parser.add_argument('--wdecay', type=float, default=.00001, help="Weight decay in optimizer.")
+    parser.add_argument('--log_freq', type=int, default=100, help="steps between training logs")
+    parser.add_argument('--save_freq', type=int, default=1000, help="steps between checkpoints")
+    parser.add_argument('--checkpoint_updates', action='store_true', help="recompute each update iteration in the backward pass to save memory")
+
+    # Architecture choices
+    parser.add_argument('--hidden_dims', nargs='+', type=int, default=[128]*3, help="hidden state and context dimensions")
+    parser.add_argument('--corr_implementation', choices=["reg", "alt", "alt_fast"], default="alt", help="correlation volume implementation, as exported")
+    parser.add_argument('--shared_backbone', action='store_true', help="use a single backbone for the context and feature encoders")
+    parser.add_argument('--corr_levels', type=int, default=4, help="number of levels in the correlation pyramid")
+    parser.add_argument('--corr_radius', type=int, default=4, choices=[1, 4], help="width of the correlation pyramid, as exported")
+    parser.add_argument('--n_downsample', type=int, default=2, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--context_norm', type=str, default="batch", choices=['group', 'batch', 'instance', 'none'], help="normalization of context encoder")
+    parser.add_argument('--slow_fast_gru', action='store_true', help="iterate the low-res GRUs more frequently")
+    parser.add_argument('--n_gru_layers', type=int, default=3, help="number of hidden GRU levels")
+
+    # Data augmentation
+    parser.add_argument('--img_gamma', type=float, nargs='+', default=None, help="gamma range")
+    parser.add_argument('--saturation_range', type=float, nargs='+', default=None, help='color saturation')
+    parser.add_argument('--do_flip', default=False, choices=['h', 'v'], help='flip the images horizontally or vertically')
+    parser.add_argument('--spatial_scale', type=float, nargs='+', default=[-0.2, 0.4], help='re-scale the images randomly')
+    parser.add_argument('--noyjitter', action='store_true', help='don\'t simulate imperfect rectification')
+
+    args = parser.parse_args()
+    torch.manual_seed(1234)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
+    if args.qat_ckpt is not None:
+        Path(args.output_directory).mkdir(exist_ok=True, parents=True)
+        export_qdq(load_model(prepare_qat(load_export_model(args, args.restore_ckpt)[0]), args.qat_ckpt), args, args.output_directory)
+    else:
+        train(args)
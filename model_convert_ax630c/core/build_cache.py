@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+CORE_DIR = Path(__file__).resolve().parent
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ sha256 of a file, read in chunks so large checkpoints are not loaded at once """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_digest(*extra_files):
+    """ sha256 of every .py file under core/ (path and content) and of extra_files, e.g. the export script """
+    h = hashlib.sha256()
+    for path in sorted(CORE_DIR.rglob('*.py')):
+        h.update(path.relative_to(CORE_DIR).as_posix().encode())
+        h.update(path.read_bytes())
+    for path in extra_files:
+        h.update(Path(path).read_bytes())
+    return h.hexdigest()
+
+
+def package_versions(*names):
+    versions = {}
+    for name in names:
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return versions
+
+
+def build_key(checkpoint, options, sources=(), packages=("torch", "onnx", "onnxsim")):
+    """ Identity of an export: checkpoint content, architecture and export options, source code and tool versions
+
+    Returns the key and the manifest it hashes; options must be JSON serializable.
+    """
+    manifest = {"checkpoint": file_digest(checkpoint), "options": options,
+                "sources": source_digest(*sources), "versions": package_versions(*packages)}
+    key = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return key, manifest
+
+
+class BuildCache:
+    """ Content-addressed on-disk cache of exported models
+
+    Each entry is <key><suffix> plus <key>.json holding the manifest it was built from, so cached
+    variants can be listed and traced back to their checkpoint and options. Files are written to a
+    temporary name and renamed, a build interrupted half-way never becomes a cache hit.
+
+    Only the single file is cached: models must be self-contained, ONNX weights saved inline rather than
+    in external-data sidecars (export_onnx.py does so, which limits exports to the 2GB protobuf size).
+    """
+
+    def __init__(self, root, suffix='.onnx'):
+        self.root = Path(root)
+        self.suffix = suffix
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.root / (key + self.suffix)
+
+    def get(self, key, dst):
+        """ Copy the entry of key to dst, False if there is none """
+        path = self._path(key)
+        if not path.exists():
+            return False
+        _copy(path, Path(dst))
+        return True
+
+    def put(self, key, src, manifest):
+        _copy(Path(src), self._path(key))
+        tmp_path = self.root / f"{key}.json.{os.getpid()}.tmp"
+        tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(tmp_path, self.root / f"{key}.json")
+
+
+def _copy(src, dst):
+    tmp_path = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
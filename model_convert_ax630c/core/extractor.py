@@ -120,33 +120,34 @@ class BottleneckBlock(nn.Module):
         return self.relu(x+y)
 
 class BasicEncoder(nn.Module):
-    def __init__(self, output_dim=128, norm_fn='batch', dropout=0.0, downsample=3):
+    def __init__(self, output_dim=128, norm_fn='batch', dropout=0.0, downsample=3, dims=(64, 64, 96, 128)):
+        """ dims: channels of the stem and of the three residual stages """
         super(BasicEncoder, self).__init__()
         self.norm_fn = norm_fn
         self.downsample = downsample
 
         if self.norm_fn == 'group':
-            self.norm1 = nn.GroupNorm(num_groups=8, num_channels=64)
+            self.norm1 = nn.GroupNorm(num_groups=8, num_channels=dims[0])
             
         elif self.norm_fn == 'batch':
-            self.norm1 = nn.BatchNorm2d(64)
+            self.norm1 = nn.BatchNorm2d(dims[0])
 
         elif self.norm_fn == 'instance':
-            self.norm1 = nn.InstanceNorm2d(64)
+            self.norm1 = nn.InstanceNorm2d(dims[0])
 
         elif self.norm_fn == 'none':
             self.norm1 = nn.Sequential()
 
-        self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=1 + (downsample > 2), padding=3)
+        self.conv1 = nn.Conv2d(3, dims[0], kernel_size=7, stride=1 + (downsample > 2), padding=3)
         self.relu1 = nn.ReLU(inplace=True)
 
-        self.in_planes = 64
-        self.layer1 = self._make_layer(64,  stride=1)
-        self.layer2 = self._make_layer(96, stride=1 + (downsample > 1))
-        self.layer3 = self._make_layer(128, stride=1 + (downsample > 0))
+        self.in_planes = dims[0]
+        self.layer1 = self._make_layer(dims[1], stride=1)
+        self.layer2 = self._make_layer(dims[2], stride=1 + (downsample > 1))
+        self.layer3 = self._make_layer(dims[3], stride=1 + (downsample > 0))
 
         # output convolution
-        self.conv2 = nn.Conv2d(128, output_dim, kernel_size=1)
+        self.conv2 = nn.Conv2d(dims[3], output_dim, kernel_size=1)
 
         self.dropout = None
         if dropout > 0:
@@ -197,38 +198,39 @@ class BasicEncoder(nn.Module):
         return x
 
 class MultiBasicEncoder(nn.Module):
-    def __init__(self, output_dim=[128], norm_fn='batch', dropout=0.0, downsample=3):
+    def __init__(self, output_dim=[128], norm_fn='batch', dropout=0.0, downsample=3, dims=(64, 64, 96, 128)):
+        """ dims: channels of the stem and of the residual stages, the last also of the 1/2^(K+1) and 1/2^(K+2) stages """
         super(MultiBasicEncoder, self).__init__()
         self.norm_fn = norm_fn
         self.downsample = downsample
 
         if self.norm_fn == 'group':
-            self.norm1 = nn.GroupNorm(num_groups=8, num_channels=64)
+            self.norm1 = nn.GroupNorm(num_groups=8, num_channels=dims[0])
 
         elif self.norm_fn == 'batch':
-            self.norm1 = nn.BatchNorm2d(64)
+            self.norm1 = nn.BatchNorm2d(dims[0])
 
         elif self.norm_fn == 'instance':
-            self.norm1 = nn.InstanceNorm2d(64)
+            self.norm1 = nn.InstanceNorm2d(dims[0])
 
         elif self.norm_fn == 'none':
             self.norm1 = nn.Sequential()
 
-        self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=1 + (downsample > 2), padding=3)
+        self.conv1 = nn.Conv2d(3, dims[0], kernel_size=7, stride=1 + (downsample > 2), padding=3)
         self.relu1 = nn.ReLU(inplace=True)
 
-        self.in_planes = 64
-        self.layer1 = self._make_layer(64, stride=1)
-        self.layer2 = self._make_layer(96, stride=1 + (downsample > 1))
-        self.layer3 = self._make_layer(128, stride=1 + (downsample > 0))
-        self.layer4 = self._make_layer(128, stride=2)
-        self.layer5 = self._make_layer(128, stride=2)
+        self.in_planes = dims[0]
+        self.layer1 = self._make_layer(dims[1], stride=1)
+        self.layer2 = self._make_layer(dims[2], stride=1 + (downsample > 1))
+        self.layer3 = self._make_layer(dims[3], stride=1 + (downsample > 0))
+        self.layer4 = self._make_layer(dims[3], stride=2)
+        self.layer5 = self._make_layer(dims[3], stride=2)
 
         output_list = []
         for dim in output_dim:
             conv_out = nn.Sequential(
-                ResidualBlock(128, 128, self.norm_fn, stride=1),
-                nn.Conv2d(128, dim[2], 3, padding=1))
+                ResidualBlock(dims[3], dims[3], self.norm_fn, stride=1),
+                nn.Conv2d(dims[3], dim[2], 3, padding=1))
             output_list.append(conv_out)
 
         self.outputs08 = nn.ModuleList(output_list)
@@ -236,15 +238,15 @@ class MultiBasicEncoder(nn.Module):
         output_list = []
         for dim in output_dim:
             conv_out = nn.Sequential(
-                ResidualBlock(128, 128, self.norm_fn, stride=1),
-                nn.Conv2d(128, dim[1], 3, padding=1))
+                ResidualBlock(dims[3], dims[3], self.norm_fn, stride=1),
+                nn.Conv2d(dims[3], dim[1], 3, padding=1))
             output_list.append(conv_out)
 
         self.outputs16 = nn.ModuleList(output_list)
 
         output_list = []
         for dim in output_dim:
-            conv_out = nn.Conv2d(128, dim[0], 3, padding=1)
+            conv_out = nn.Conv2d(dims[3], dim[0], 3, padding=1)
             output_list.append(conv_out)
 
         self.outputs32 = nn.ModuleList(output_list)
@@ -271,8 +273,8 @@ class MultiBasicEncoder(nn.Module):
         self.in_planes = dim
         return nn.Sequential(*layers)
 
-    def forward(self, x, dual_inp=False, num_layers=3):
-
+    def trunk(self, x):
+        """ Stem and residual layers up to 1/2^K resolution, shared with the feature encoder by RAFTStereo.conv2 """
         x = self.conv1(x)
         x = self.norm1(x)
         x = self.relu1(x)
@@ -280,21 +282,31 @@ class MultiBasicEncoder(nn.Module):
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
-        if dual_inp:
-            v = x
-            x = x[:(x.shape[0]//2)]
+        return x
 
+    def heads(self, x, num_layers=3):
+        """ Context outputs at 1/2^K, 1/2^(K+1) and 1/2^(K+2) resolution from the trunk features """
         outputs08 = [f(x) for f in self.outputs08]
         if num_layers == 1:
-            return (outputs08, v) if dual_inp else (outputs08,)
+            return (outputs08,)
 
         y = self.layer4(x)
         outputs16 = [f(y) for f in self.outputs16]
 
         if num_layers == 2:
-            return (outputs08, outputs16, v) if dual_inp else (outputs08, outputs16)
+            return (outputs08, outputs16)
 
         z = self.layer5(y)
         outputs32 = [f(z) for f in self.outputs32]
 
-        return (outputs08, outputs16, outputs32, v) if dual_inp else (outputs08, outputs16, outputs32)
+        return (outputs08, outputs16, outputs32)
+
+    def forward(self, x, dual_inp=False, num_layers=3):
+
+        x = self.trunk(x)
+        if dual_inp:
+            v = x
+            x = x[:(x.shape[0]//2)]
+
+        outputs = self.heads(x, num_layers)
+        return (*outputs, v) if dual_inp else outputs
@@ -0,0 +1,62 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from runner import StereoRunner
+from upsample import convex_upsample, disparity_map
+
+
+def median_ms(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def bench_model(model, left, right, repeats):
+    """ Median inference and host upsampling time of one model, with and without the convex upsampling """
+    runner = StereoRunner(model)
+    feed = {runner.left_name: runner.preprocess(left), runner.right_name: runner.preprocess(right)}
+    outputs = runner.session.run(None, feed)
+    inference = median_ms(lambda: runner.session.run(None, feed), repeats)
+    upsample = median_ms(lambda: disparity_map(outputs, runner.lowres), repeats)
+    skipped = median_ms(lambda: disparity_map(outputs, runner.lowres, skip_upsample=True), repeats)
+    return dict(model=model, lowres=runner.lowres, inference_ms=inference, upsample_ms=upsample, skip_ms=skipped)
+
+
+def main(args):
+    rows = []
+    if args.left and args.right:
+        left = cv2.cvtColor(cv2.imread(args.left), cv2.COLOR_BGR2RGB)
+        right = cv2.cvtColor(cv2.imread(args.right), cv2.COLOR_BGR2RGB)
+        rows = [bench_model(model, left, right, args.repeats) for model in args.models]
+
+    print("| model | upsampling on | inference (ms) | host upsample (ms) | total (ms) | total, skipped (ms) |")
+    print("|---|---|---|---|---|---|")
+    for r in rows:
+        print(f"| {r['model']} | {'host' if r['lowres'] else 'model'} | {r['inference_ms']:.2f} | {r['upsample_ms']:.2f} | "
+              f"{r['inference_ms'] + r['upsample_ms']:.2f} | {r['inference_ms'] + r['skip_ms']:.2f} |")
+
+    # host cost alone, for sizing targets without running a model
+    factor = 2 ** args.n_downsample
+    H, W = args.height // factor, args.width // factor
+    flow = np.random.randn(1, 1, H, W).astype(np.float32)
+    mask = np.random.randn(1, 9 * factor * factor, H, W).astype(np.float32)
+    ms = median_ms(lambda: convex_upsample(flow, mask), args.repeats)
+    print(f"\nhost convex upsampling {H}x{W} -> {args.height}x{args.width}: {ms:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', nargs='*', default=[], help="full and _lowres .axmodel/.onnx models to compare")
+    parser.add_argument('--left', default=None, help="left image")
+    parser.add_argument('--right', default=None, help="right image")
+    parser.add_argument('--width', type=int, default=640, help="model input width for the host-only timing")
+    parser.add_argument('--height', type=int, default=256, help="model input height for the host-only timing")
+    parser.add_argument('--n_downsample', type=int, default=3, help="resolution of the disparity field (1/2^K)")
+    parser.add_argument('--repeats', type=int, default=20, help="timed runs (median is reported)")
+
+    args = parser.parse_args()
+    main(args)
@@ -1,8 +1,13 @@
 import argparse
+import os
+import time
 import cv2
 # from PIL import Image
 import numpy as np
 import matplotlib.pyplot as plt
+from disparity_cache import open_cache
+from runner import PREPROCESS_SECONDS, INFERENCE_SECONDS, POSTPROCESS_SECONDS, FRAMES
+from upsample import is_lowres, disparity_map
 
 try:
     import axengine as axe
@@ -50,8 +55,43 @@ def resize_disp(disp, target_width, target_height, use_cv2=True):
     return disp
 
 
-def load_and_preprocess_image(image_path, target_width, target_height, use_cv2=True):
-    if use_cv2:
+def bgr_to_nv12(img):
+    h, w = img.shape[:2]
+    i420 = cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420)
+    y = i420[:h]
+    chroma = i420[h:].reshape(2, h // 2, w // 2)
+    uv = np.stack([chroma[0], chroma[1]], axis=-1).reshape(h // 2, w)
+    return np.concatenate([y, uv], axis=0)
+
+
+def resize_nv12(nv12, target_width, target_height):
+    # Resize the Y and interleaved UV planes separately so the frame never leaves YUV
+    height = nv12.shape[0] * 2 // 3
+    width = nv12.shape[1]
+    y = nv12[:height]
+    uv = nv12[height:].reshape(height // 2, width // 2, 2)
+    y = cv2.resize(y, (target_width, target_height))
+    uv = cv2.resize(uv, (target_width // 2, target_height // 2))
+    return np.concatenate([y, uv.reshape(target_height // 2, target_width)], axis=0)
+
+
+def load_nv12(image_path, src_size=None):
+    """ Read a raw .nv12/.yuv frame (src_size=(width, height)) or encode an image file to NV12 """
+    if image_path.endswith(('.nv12', '.yuv')):
+        assert src_size is not None, "raw NV12 input requires --src_width and --src_height"
+        src_width, src_height = src_size
+        return np.fromfile(image_path, dtype=np.uint8).reshape(src_height * 3 // 2, src_width)
+    img = cv2.imread(image_path)
+    h, w = img.shape[:2]
+    return bgr_to_nv12(img[:h - h % 2, :w - w % 2])
+
+
+def load_and_preprocess_image(image_path, target_width, target_height, use_cv2=True, input_format="rgb", src_size=None):
+    if input_format == "nv12":
+        nv12 = load_nv12(image_path, src_size)
+        orig_height, orig_width = nv12.shape[0] * 2 // 3, nv12.shape[1]
+        img_batch = resize_nv12(nv12, target_width, target_height)[None, :, :, None]
+    elif use_cv2:
         img = cv2.imread(image_path)
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) 
         orig_height, orig_width = img.shape[:2]
@@ -75,21 +115,54 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--width", type=int, required=True, help="Width of input image.")
     parser.add_argument("--height", type=int, required=True, help="Height of input image.")
     parser.add_argument("--output", type=str, default="output-ax.png", help="Output file path.")
+    parser.add_argument("--input_format", type=str, default="rgb", choices=["rgb", "nv12"],
+                        help="Input tensor format, nv12 requires a model built with config_*_nv12.json.")
+    parser.add_argument("--src_width", type=int, default=None, help="Width of raw .nv12/.yuv input frames.")
+    parser.add_argument("--src_height", type=int, default=None, help="Height of raw .nv12/.yuv input frames.")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory of the on-disk disparity cache (disabled if unset).")
+    parser.add_argument("--cache_size_mb", type=float, default=512, help="Max size of the disparity cache in MB.")
+    parser.add_argument("--cache_fp16", action="store_true",
+                        help="Store cached disparities as float16: half the size, but hits differ from the model output by rounding.")
+    parser.add_argument("--skip_upsample", action="store_true",
+                        help="For _lowres models, resize the 1/2^K disparity bilinearly instead of the convex upsampling.")
     return parser.parse_args()
 
 
-def infer(left: str, right: str, model: str, width: int, height: int, output: str = "output-ax.png"):
+def infer(left: str, right: str, model: str, width: int, height: int, output: str = "output-ax.png",
+          input_format: str = "rgb", src_width: int = None, src_height: int = None,
+          cache_dir: str = None, cache_size_mb: float = 512, cache_fp16: bool = False, skip_upsample: bool = False):
+    src_size = (src_width, src_height) if src_width and src_height else None
+
+    cache = open_cache(cache_dir, cache_size_mb, np.float16 if cache_fp16 else np.float32)
+    if cache is not None:
+        cache_key = cache.key(model, left, right, width=width, height=height, input_format=input_format,
+                              src_size=src_size, use_cv2=enable_cv2, skip_upsample=skip_upsample)
+        result = cache.get(cache_key)
+        if result is not None:
+            plt.imsave(output, result, cmap='jet')
+            print(f"Saved (cached): {output}")
+            return result
+
     if axe is None:
         raise RuntimeError("axengine is not installed")
-    
-    image_left, (orig_h_left, orig_w_left) = load_and_preprocess_image(left, width, height, use_cv2=enable_cv2)
-    image_right, (orig_h_right, orig_w_right) = load_and_preprocess_image(right, width, height, use_cv2=enable_cv2)
+    session = axe.InferenceSession(model, providers=['AxEngineExecutionProvider'])
+
+    # same per-stage histograms as StereoRunner, preprocessing here includes reading the images
+    model_name = os.path.basename(model)
+    t0 = time.perf_counter()
+    image_left, (orig_h_left, orig_w_left) = load_and_preprocess_image(left, width, height, use_cv2=enable_cv2,
+                                                                       input_format=input_format, src_size=src_size)
+    image_right, (orig_h_right, orig_w_right) = load_and_preprocess_image(right, width, height, use_cv2=enable_cv2,
+                                                                          input_format=input_format, src_size=src_size)
 
     assert orig_h_left == orig_h_right and orig_w_left == orig_w_right
 
-    session = axe.InferenceSession(model, providers=['AxEngineExecutionProvider'])
-    
     input_names = [inp.name for inp in session.get_inputs()]
+    if input_format == "nv12":
+        input_shape = session.get_inputs()[0].shape
+        image_left = image_left.reshape(input_shape)
+        image_right = image_right.reshape(input_shape)
+
     feed_dict = {}
     for name in input_names:
         if 'x1' in name or 'left' in name.lower():
@@ -99,13 +172,23 @@ def infer(left: str, right: str, model: str, width: int, height: int, output: st
     
     if len(feed_dict) < 2 and len(input_names) >= 2:
         feed_dict = {input_names[0]: image_left, input_names[1]: image_right}
+    t1 = time.perf_counter()
     
     outputs = session.run(None, feed_dict)
-    flow_up = outputs[0]
+    t2 = time.perf_counter()
+    flow_up = disparity_map(outputs, is_lowres(session), skip_upsample)
 
-    flow_up = resize_disp(flow_up[0, 0], orig_w_left, orig_h_left, use_cv2=enable_cv2)
+    flow_up = resize_disp(flow_up, orig_w_left, orig_h_left, use_cv2=enable_cv2)
     flow_up *= orig_w_left / width
     result = np.abs(flow_up)
+    t3 = time.perf_counter()
+
+    PREPROCESS_SECONDS.labels(model_name).observe(t1 - t0)
+    INFERENCE_SECONDS.labels(model_name).observe(t2 - t1)
+    POSTPROCESS_SECONDS.labels(model_name).observe(t3 - t2)
+    FRAMES.labels(model_name).inc()
+    if cache is not None:
+        cache.put(cache_key, result)
     
     plt.imsave(output, result, cmap='jet')
     print(f"Saved: {output}")
@@ -1,8 +1,14 @@
 import argparse
+import os
+import time
 import cv2
 import numpy as np
 import onnxruntime as ort
 import matplotlib.pyplot as plt
+from infer import load_nv12
+from disparity_cache import open_cache
+from runner import PREPROCESS_SECONDS, INFERENCE_SECONDS, POSTPROCESS_SECONDS, FRAMES
+from upsample import is_lowres, disparity_map
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -24,11 +30,42 @@ def parse_args() -> argparse.Namespace:
         required=True,
         help="Path to ONNX model.",
     )
-    
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        default="rgb",
+        choices=["rgb", "nv12"],
+        help="Input image format, nv12 frames are converted to RGB on the host.",
+    )
+    parser.add_argument("--src_width", type=int, default=None, help="Width of raw .nv12/.yuv input frames.")
+    parser.add_argument("--src_height", type=int, default=None, help="Height of raw .nv12/.yuv input frames.")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory of the on-disk disparity cache (disabled if unset).")
+    parser.add_argument("--cache_size_mb", type=float, default=512, help="Max size of the disparity cache in MB.")
+    parser.add_argument("--cache_fp16", action="store_true",
+                        help="Store cached disparities as float16: half the size, but hits differ from the model output by rounding.")
+    parser.add_argument("--skip_upsample", action="store_true",
+                        help="For _lowres models, resize the 1/2^K disparity bilinearly instead of the convex upsampling.")
+
     return parser.parse_args()
 
 
-def infer(left: str, right: str, model: str):
+def read_rgb(path, input_format="rgb", src_size=None):
+    if input_format == "nv12":
+        return cv2.cvtColor(load_nv12(path, src_size), cv2.COLOR_YUV2RGB_NV12)
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+
+def infer(left: str, right: str, model: str, input_format: str = "rgb", src_width: int = None, src_height: int = None,
+          cache_dir: str = None, cache_size_mb: float = 512, cache_fp16: bool = False, skip_upsample: bool = False):
+
+    src_size = (src_width, src_height) if src_width and src_height else None
+    cache = open_cache(cache_dir, cache_size_mb, np.float16 if cache_fp16 else np.float32)
+    if cache is not None:
+        cache_key = cache.key(model, left, right, input_format=input_format, src_size=src_size, skip_upsample=skip_upsample)
+        output = cache.get(cache_key)
+        if output is not None:
+            plt.imsave(f"output-onnx.png", output, cmap='jet')
+            return output
 
     session = ort.InferenceSession(
         model, providers=["CUDAExecutionProvider", "CPUExecutionProvider"]
@@ -41,16 +78,17 @@ def infer(left: str, right: str, model: str):
 
     H,W = input_info[0]['shape'][2:4]
 
-    left_raw = cv2.imread(left)
-    image_left = cv2.cvtColor(left_raw, cv2.COLOR_BGR2RGB) 
+    # same per-stage histograms as StereoRunner, preprocessing here includes reading the images
+    model_name = os.path.basename(model)
+    t0 = time.perf_counter()
+    image_left = read_rgb(left, input_format, src_size)
     orig_h_left, orig_w_left = image_left.shape[:2]
     image_left = cv2.resize(image_left, (W,H) )
    
     image_left = image_left.transpose(2,0,1)
     image_left = image_left[None].astype(np.float32)
 
-    right_raw = cv2.imread(right)
-    image_right = cv2.cvtColor(right_raw, cv2.COLOR_BGR2RGB) 
+    image_right = read_rgb(right, input_format, src_size)
     orig_h_right, orig_w_right = image_right.shape[:2]
     image_right = cv2.resize(image_right, (W,H) )
    
@@ -58,14 +96,24 @@ def infer(left: str, right: str, model: str):
     image_right = image_right[None].astype(np.float32)
 
     assert orig_h_left == orig_h_right and orig_w_left == orig_w_right
+    t1 = time.perf_counter()
 
+    outputs = session.run(None, {input_info[0]['name']: image_left, input_info[1]['name']:image_right})
+    t2 = time.perf_counter()
+    flow_up = disparity_map(outputs, is_lowres(session), skip_upsample)
     
-    flow_up = session.run(None, {input_info[0]['name']: image_left, input_info[1]['name']:image_right})[0]
-    
-    flow_up = cv2.resize(flow_up[0,0], (orig_w_left, orig_h_left))
+    flow_up = cv2.resize(flow_up, (orig_w_left, orig_h_left))
     flow_up *= orig_w_left/W
     
     output = np.abs(flow_up)
+    t3 = time.perf_counter()
+
+    PREPROCESS_SECONDS.labels(model_name).observe(t1 - t0)
+    INFERENCE_SECONDS.labels(model_name).observe(t2 - t1)
+    POSTPROCESS_SECONDS.labels(model_name).observe(t3 - t2)
+    FRAMES.labels(model_name).inc()
+    if cache is not None:
+        cache.put(cache_key, output)
     
     plt.imsave(f"output-onnx.png", output, cmap='jet')
 
@@ -0,0 +1,232 @@
+import abc
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    """ Label value with backslash, double quote and newline escaped, as the Prometheus text format requires """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """ Fresh child holding the value of one label combination """
+
+    def labels(self, *values):
+        """ Child bound to one label combination; keep it around on hot paths to skip the lookup """
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            assert len(values) == len(self.labelnames), f"{self.name} expects labels {self.labelnames}"
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1.0):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Registry:
+    """ Process-wide collection of counters, gauges and histograms """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            assert isinstance(metric, cls), f"{name} is already registered as a {metric.kind}"
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def snapshot(self):
+        """ Plain-dict view of every metric, e.g. for logging or tests """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {}
+        for metric in metrics:
+            samples = []
+            for values, child in metric.samples():
+                labels = dict(zip(metric.labelnames, values))
+                if metric.kind == "histogram":
+                    with child._lock:
+                        samples.append(dict(labels=labels, buckets=dict(zip(metric.buckets + (float("inf"),), child.counts)),
+                                            sum=child.sum, count=child.count))
+                else:
+                    samples.append(dict(labels=labels, value=child.value))
+            result[metric.name] = dict(type=metric.kind, help=metric.help, samples=samples)
+        return result
+
+    def render(self):
+        """ Prometheus text exposition format """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for values, child in metric.samples():
+                if metric.kind != "histogram":
+                    lines.append(f"{metric.name}{_format_labels(metric.labelnames, values)} {child.value}")
+                    continue
+                with child._lock:
+                    counts, total, count = list(child.counts), child.sum, child.count
+                cumulative = 0
+                for bound, n in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, values, [('le', le)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{_format_labels(metric.labelnames, values)} {total}")
+                lines.append(f"{metric.name}_count{_format_labels(metric.labelnames, values)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port, addr="127.0.0.1"):
+        """ Serve render() at /metrics from a daemon thread; returns the server (call shutdown() to stop) """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+REGISTRY = Registry()
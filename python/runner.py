@@ -0,0 +1,120 @@
+import os
+import time
+import cv2
+import numpy as np
+from metrics import REGISTRY
+from tracing import TRACER
+from upsample import is_lowres, disparity_map, convex_upsample_points
+
+try:
+    import axengine as axe
+except ImportError:
+    axe = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+PREPROCESS_SECONDS = REGISTRY.histogram("raft_preprocess_seconds", "Host preprocessing time per frame", ["model"])
+INFERENCE_SECONDS = REGISTRY.histogram("raft_inference_seconds", "Model inference time per frame", ["model"])
+POSTPROCESS_SECONDS = REGISTRY.histogram("raft_postprocess_seconds", "Host postprocessing time per frame", ["model"])
+FRAMES = REGISTRY.counter("raft_frames_total", "Frames run through the model", ["model"])
+SESSIONS = REGISTRY.gauge("raft_sessions", "Open inference sessions", ["model"])
+
+
+class StereoRunner:
+    """ Runs an .axmodel or .onnx stereo model on RGB image pairs of any resolution """
+
+    def __init__(self, model, skip_upsample=False):
+        self.model = model
+        self.skip_upsample = skip_upsample
+        if model.endswith('.onnx'):
+            if ort is None:
+                raise RuntimeError("onnxruntime is not installed")
+            self.session = ort.InferenceSession(model, providers=["CUDAExecutionProvider", "CPUExecutionProvider"])
+            self.layout = "NCHW"
+            self.height, self.width = self.session.get_inputs()[0].shape[2:4]
+        else:
+            if axe is None:
+                raise RuntimeError("axengine is not installed")
+            self.session = axe.InferenceSession(model, providers=['AxEngineExecutionProvider'])
+            self.layout = "NHWC"
+            self.height, self.width = self.session.get_inputs()[0].shape[1:3]
+
+        model_name = os.path.basename(model)
+        self._preprocess_seconds = PREPROCESS_SECONDS.labels(model_name)
+        self._inference_seconds = INFERENCE_SECONDS.labels(model_name)
+        self._postprocess_seconds = POSTPROCESS_SECONDS.labels(model_name)
+        self._frames = FRAMES.labels(model_name)
+        self._sessions = SESSIONS.labels(model_name)
+        self._sessions.inc()
+
+        input_names = [inp.name for inp in self.session.get_inputs()]
+        self.left_name = next((n for n in input_names if 'x1' in n or 'left' in n.lower()), input_names[0])
+        self.right_name = next((n for n in input_names if n != self.left_name), input_names[-1])
+        # exported with --lowres_output: 1/2^K flow and mask logits, convex upsampling is done here
+        self.lowres = is_lowres(self.session)
+
+    def close(self):
+        """ Release the session and take it off the raft_sessions gauge, the runner cannot be used afterwards """
+        sessions, self._sessions = getattr(self, "_sessions", None), None
+        if sessions is not None:
+            sessions.dec()
+            self.session = None
+
+    def __del__(self):
+        self.close()
+
+    def preprocess(self, image):
+        img = cv2.resize(image, (self.width, self.height))
+        if self.layout == "NCHW":
+            return img.transpose(2, 0, 1)[None].astype(np.float32)
+        return img[None]
+
+    def postprocess(self, outputs, orig_w, orig_h):
+        disp = cv2.resize(disparity_map(outputs, self.lowres, self.skip_upsample), (orig_w, orig_h))
+        disp = np.abs(disp * (orig_w / self.width))
+        valid = None
+        if len(outputs) > 1 and not self.lowres:
+            valid = cv2.resize(outputs[1][0, 0], (orig_w, orig_h), interpolation=cv2.INTER_NEAREST)
+        return disp, valid
+
+    def __call__(self, image_left, image_right, frame=None):
+        """ Returns the disparity at the input resolution and the consistency mask if the model exports one """
+        orig_h, orig_w = image_left.shape[:2]
+        t0 = time.perf_counter()
+        with TRACER.span("preprocess", frame):
+            feed = {self.left_name: self.preprocess(image_left), self.right_name: self.preprocess(image_right)}
+        t1 = time.perf_counter()
+        with TRACER.span("inference", frame):
+            outputs = self.session.run(None, feed)
+        t2 = time.perf_counter()
+        with TRACER.span("postprocess", frame):
+            result = self.postprocess(outputs, orig_w, orig_h)
+        t3 = time.perf_counter()
+
+        self._preprocess_seconds.observe(t1 - t0)
+        self._inference_seconds.observe(t2 - t1)
+        self._postprocess_seconds.observe(t3 - t2)
+        self._frames.inc()
+        return result
+
+    def query_points(self, image_left, image_right, points, frame=None):
+        """ Disparity only at the (x, y) pixels points (N, 2) of the input resolution -> (N,) """
+        orig_h, orig_w = image_left.shape[:2]
+        with TRACER.span("preprocess", frame):
+            feed = {self.left_name: self.preprocess(image_left), self.right_name: self.preprocess(image_right)}
+        with TRACER.span("inference", frame):
+            outputs = self.session.run(None, feed)
+        with TRACER.span("postprocess", frame):
+            scale = np.array([self.width / orig_w, self.height / orig_h], dtype=np.float32)
+            model_points = np.asarray(points, dtype=np.float32) * scale
+            if self.lowres:
+                disp = convex_upsample_points(outputs[0], outputs[1], model_points)
+            else:
+                x = np.clip(np.rint(model_points[:, 0]).astype(np.int64), 0, self.width - 1)
+                y = np.clip(np.rint(model_points[:, 1]).astype(np.int64), 0, self.height - 1)
+                disp = outputs[0][0, 0, y, x]
+        self._frames.inc()
+        return np.abs(disp * (orig_w / self.width))
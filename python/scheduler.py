@@ -0,0 +1,249 @@
+import argparse
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+import cv2
+import numpy as np
+from runner import StereoRunner
+from metrics import REGISTRY
+from tracing import TRACER
+
+QUEUE_DEPTH = REGISTRY.gauge("raft_scheduler_queue_depth", "Frames waiting for a session", ["stream"])
+FRAMES_PROCESSED = REGISTRY.counter("raft_scheduler_frames_processed_total", "Frames run for a stream", ["stream"])
+FRAMES_DROPPED = REGISTRY.counter("raft_scheduler_frames_dropped_total", "Frames dropped as stale", ["stream"])
+FRAMES_FAILED = REGISTRY.counter("raft_scheduler_frames_failed_total", "Frames whose inference or callback raised", ["stream"])
+FRAME_LATENCY = REGISTRY.histogram("raft_scheduler_latency_seconds", "Capture to result latency", ["stream"])
+
+logger = logging.getLogger(__name__)
+
+
+class Frame:
+    __slots__ = ("stream", "frame_id", "image_left", "image_right", "timestamp", "deadline", "priority", "cancelled")
+
+    def __init__(self, stream, frame_id, image_left, image_right, timestamp, deadline):
+        self.stream = stream
+        self.frame_id = frame_id
+        self.image_left = image_left
+        self.image_right = image_right
+        self.timestamp = timestamp
+        self.deadline = deadline
+        self.priority = deadline
+        self.cancelled = False
+
+
+class Stream:
+    def __init__(self, name, deadline, max_pending, callback):
+        self.name = name
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.callback = callback
+        self.pending = deque()
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+        self.done_times = deque(maxlen=1000)
+        self.queue_depth = QUEUE_DEPTH.labels(name)
+        self.processed_total = FRAMES_PROCESSED.labels(name)
+        self.dropped_total = FRAMES_DROPPED.labels(name)
+        self.errors_total = FRAMES_FAILED.labels(name)
+        self.latency_seconds = FRAME_LATENCY.labels(name)
+
+    def drop(self):
+        self.dropped += 1
+        self.dropped_total.inc()
+
+    def fail(self):
+        self.errors += 1
+        self.errors_total.inc()
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        fps = 0.0
+        if len(self.done_times) > 1:
+            fps = (len(self.done_times) - 1) / max(self.done_times[-1] - self.done_times[0], 1e-9)
+        return dict(submitted=self.submitted, processed=self.processed, dropped=self.dropped,
+                    errors=self.errors, drop_rate=self.dropped / max(self.submitted, 1), fps=fps,
+                    latency_mean_ms=float(latencies.mean()), latency_p50_ms=float(np.percentile(latencies, 50)),
+                    latency_p95_ms=float(np.percentile(latencies, 95)), latency_max_ms=float(latencies.max()))
+
+
+class StreamScheduler:
+    """ Earliest-deadline-first scheduling of frames from several stereo streams onto a pool of sessions
+
+    Each stream keeps at most `max_pending` queued frames: a new frame evicts the oldest pending one and
+    inherits its place in the queue, so a stream that falls behind is not starved by the others. Frames
+    whose own deadline has passed before a session picks them up are dropped instead of run, which keeps
+    the latency of every stream bounded when the board is overloaded. A frame whose inference or callback
+    raises is counted as an error of its stream, the session goes on with the next frame.
+    """
+
+    def __init__(self, model, num_sessions=1):
+        self.runners = [StereoRunner(model) for _ in range(num_sessions)]
+        self.streams = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._workers = [threading.Thread(target=self._worker, args=(runner,), daemon=True) for runner in self.runners]
+        for worker in self._workers:
+            worker.start()
+
+    def add_stream(self, name, deadline=0.2, max_pending=1, callback=None):
+        """ deadline: seconds after capture by which a frame's result is still useful """
+        with self._cond:
+            self.streams[name] = Stream(name, deadline, max_pending, callback)
+
+    def submit(self, name, image_left, image_right, frame_id=None, timestamp=None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("submit() on a closed StreamScheduler")
+            stream = self.streams[name]
+            frame = Frame(stream, stream.submitted if frame_id is None else frame_id, image_left, image_right,
+                          timestamp, timestamp + stream.deadline)
+            stream.submitted += 1
+            while len(stream.pending) >= stream.max_pending:
+                evicted = stream.pending.popleft()
+                evicted.cancelled = True
+                frame.priority = min(frame.priority, evicted.priority)
+                stream.drop()
+            stream.pending.append(frame)
+            stream.queue_depth.set(len(stream.pending))
+            heapq.heappush(self._queue, (frame.priority, next(self._seq), frame))
+            self._cond.notify()
+
+    def _next_frame(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._queue:
+                    _, _, frame = heapq.heappop(self._queue)
+                    if frame.cancelled:
+                        continue
+                    frame.stream.pending.remove(frame)
+                    frame.stream.queue_depth.set(len(frame.stream.pending))
+                    if frame.deadline < now:
+                        frame.stream.drop()
+                        continue
+                    return frame
+                if not self._running:
+                    return None
+                self._cond.wait()
+
+    def _worker(self, runner):
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            stream = frame.stream
+            trace_id = f"{stream.name}/{frame.frame_id}"
+            TRACER.complete("queue_wait", frame.timestamp, time.monotonic(), trace_id)
+            try:
+                disp, valid = runner(frame.image_left, frame.image_right, frame=trace_id)
+                done = time.monotonic()
+                if stream.callback is not None:
+                    with TRACER.span("callback", trace_id):
+                        stream.callback(stream.name, frame.frame_id, disp, valid)
+            except Exception:
+                logger.exception("frame %s failed", trace_id)
+                with self._cond:
+                    stream.fail()
+                continue
+            with self._cond:
+                stream.processed += 1
+                stream.latencies.append(done - frame.timestamp)
+                stream.done_times.append(done)
+            stream.processed_total.inc()
+            stream.latency_seconds.observe(done - frame.timestamp)
+
+    def stats(self):
+        with self._cond:
+            return {name: stream.stats() for name, stream in self.streams.items()}
+
+    def _pop_pending(self):
+        """ Drop every queued frame, counting it per stream """
+        while self._queue:
+            _, _, frame = heapq.heappop(self._queue)
+            if frame.cancelled:
+                continue
+            frame.stream.pending.remove(frame)
+            frame.stream.queue_depth.set(len(frame.stream.pending))
+            frame.stream.drop()
+
+    def close(self, drain=True):
+        """ Stop the workers once the queue is empty (drain) or right away, counting the queued frames as dropped
+
+        Either way every submitted frame ends up processed, dropped or failed when close returns, and later
+        submit() calls raise.
+        """
+        with self._cond:
+            self._running = False
+            if not drain:
+                self._pop_pending()
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        for runner in self.runners:
+            runner.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--left", type=str, required=True, help="Path to left image.")
+    parser.add_argument("--right", type=str, required=True, help="Path to right image.")
+    parser.add_argument("--model", type=str, required=True, help="Path to axmodel or onnx model.")
+    parser.add_argument("--streams", type=int, default=2, help="Number of simulated streams.")
+    parser.add_argument("--fps", type=float, default=10, help="Frame rate of every simulated stream.")
+    parser.add_argument("--deadline_ms", type=float, default=200, help="Per-frame deadline after capture.")
+    parser.add_argument("--num_sessions", type=int, default=1, help="Number of inference sessions.")
+    parser.add_argument("--duration", type=float, default=10, help="Simulation time in seconds.")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Serve Prometheus metrics on this port.")
+    parser.add_argument("--trace", type=str, default=None, help="Write a Chrome trace / Perfetto JSON timeline to this path.")
+    parser.add_argument("--trace_capacity", type=int, default=100000, help="Max number of trace events kept (ring buffer).")
+    return parser.parse_args()
+
+
+def decode(left, right, frame=None):
+    with TRACER.span("decode", frame):
+        image_left = cv2.cvtColor(cv2.imread(left), cv2.COLOR_BGR2RGB)
+        image_right = cv2.cvtColor(cv2.imread(right), cv2.COLOR_BGR2RGB)
+    return image_left, image_right
+
+
+def main(args):
+    if args.trace:
+        TRACER.enable(args.trace_capacity)
+    if args.metrics_port:
+        REGISTRY.start_http_server(args.metrics_port)
+    scheduler = StreamScheduler(args.model, num_sessions=args.num_sessions)
+    names = [f"stream{i}" for i in range(args.streams)]
+    for name in names:
+        scheduler.add_stream(name, deadline=args.deadline_ms / 1000)
+
+    start = time.monotonic()
+    period = 1.0 / args.fps
+    for tick in itertools.count():
+        next_time = start + tick * period
+        if next_time - start > args.duration:
+            break
+        time.sleep(max(0.0, next_time - time.monotonic()))
+        for name in names:
+            image_left, image_right = decode(args.left, args.right, f"{name}/{tick}")
+            scheduler.submit(name, image_left, image_right, frame_id=tick)
+    scheduler.close()
+    if args.trace:
+        print(f"Saved {TRACER.export(args.trace)} trace events: {args.trace}")
+
+    for name, stats in scheduler.stats().items():
+        print(f"{name}: fps {stats['fps']:.1f}, processed {stats['processed']}/{stats['submitted']}, "
+              f"drop rate {stats['drop_rate'] * 100:.1f}%, errors {stats['errors']}, latency mean {stats['latency_mean_ms']:.1f} ms, "
+              f"p95 {stats['latency_p95_ms']:.1f} ms, max {stats['latency_max_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+_NULL_SPAN = nullcontext()
+
+
+def _now_us():
+    return time.monotonic_ns() / 1000.0
+
+
+class Tracer:
+    """ Records per-stage spans (thread, frame) into a ring buffer and exports Chrome trace / Perfetto JSON
+
+    Spans are stored as complete ("X") events with begin timestamp and duration in the time.monotonic()
+    clock, so externally measured intervals such as queue waits line up with the recorded stages. When
+    disabled, span() returns a shared no-op context manager.
+    """
+
+    def __init__(self, capacity=100000, enabled=False):
+        self.enabled = enabled
+        self.events = deque(maxlen=capacity)
+        self._thread_names = {}
+        self._pid = os.getpid()
+
+    def enable(self, capacity=None):
+        if capacity is not None and capacity != self.events.maxlen:
+            self.events = deque(self.events, maxlen=capacity)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.events.clear()
+
+    def _record(self, name, ts, dur, frame, args):
+        thread = threading.current_thread()
+        self._thread_names.setdefault(thread.ident, thread.name)
+        if frame is not None:
+            args = dict(args, frame=frame)
+        # deque.append is atomic, so recording needs no lock
+        self.events.append(dict(name=name, ph="X", ts=ts, dur=dur, pid=self._pid, tid=thread.ident, args=args))
+
+    @contextmanager
+    def _span(self, name, frame, args):
+        start = _now_us()
+        try:
+            yield
+        finally:
+            self._record(name, start, _now_us() - start, frame, args)
+
+    def span(self, name, frame=None, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, frame, args)
+
+    def complete(self, name, start, end, frame=None, **args):
+        """ Record an interval measured elsewhere, start/end in time.monotonic() seconds """
+        if self.enabled:
+            self._record(name, start * 1e6, (end - start) * 1e6, frame, args)
+
+    def export(self, path):
+        events = list(self.events)
+        metadata = [dict(name="thread_name", ph="M", pid=self._pid, tid=tid, args=dict(name=name))
+                    for tid, name in self._thread_names.items()]
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=metadata + events, displayTimeUnit="ms"), f)
+        return len(events)
+
+
+TRACER = Tracer()
@@ -0,0 +1,72 @@
+import numpy as np
+
+# output names of models exported with --lowres_output
+LOWRES_OUTPUTS = ["flow_lowres", "mask"]
+
+# (ky, kx) offsets of the 3x3 neighbourhood in F.unfold order
+_KY, _KX = np.divmod(np.arange(9), 3)
+
+
+def upsample_factor(mask):
+    """ Upsampling factor 2^K from the 9*factor^2 mask channels """
+    return int(round(np.sqrt(mask.shape[-3] / 9)))
+
+
+def is_lowres(session):
+    """ Whether the model leaves the convex upsampling to the host """
+    return [out.name for out in session.get_outputs()] == LOWRES_OUTPUTS
+
+
+def convex_upsample(flow, mask):
+    """ Convex upsampling of a low-res flow (..., H, W) with mask logits (..., 9*f*f, H, W) -> (f*H, f*W)
+
+    Same result as RAFTStereo.upsample_flow: per output pixel a softmax over the 9 mask logits weights
+    the 3x3 zero-padded neighbourhood of its low-res cell.
+    """
+    H, W = flow.shape[-2:]
+    factor = upsample_factor(mask)
+    mask = mask.reshape(9, factor * factor, H, W).astype(np.float32)
+
+    weights = np.exp(mask - mask.max(axis=0))
+    padded = np.pad(factor * flow.reshape(H, W).astype(np.float32), 1)
+    neighbors = np.stack([padded[ky:ky + H, kx:kx + W] for ky, kx in zip(_KY, _KX)])[:, None]
+    # normalize once after the weighted sum instead of normalizing all 9 weights
+    up = (weights * neighbors).sum(axis=0) / weights.sum(axis=0)
+    return up.reshape(factor, factor, H, W).transpose(2, 0, 3, 1).reshape(factor * H, factor * W)
+
+
+def disparity_map(outputs, lowres, skip_upsample=False):
+    """ Flow map (model pixels) from the model outputs, low-res outputs are upsampled on the host
+
+    With skip_upsample the low-res flow is only rescaled; the caller's resize to the output resolution
+    then does a plain bilinear upsampling instead of the convex one.
+    """
+    if not lowres:
+        return outputs[0][0, 0]
+    flow, mask = outputs[0][0], outputs[1][0]
+    if skip_upsample:
+        return upsample_factor(mask) * flow[0]
+    return convex_upsample(flow, mask)
+
+
+def convex_upsample_points(flow, mask, points):
+    """ Convex upsampling of a low-res flow (..., H, W) with mask logits (..., 9*f*f, H, W), evaluated only
+    at the full-resolution (x, y) points (N, 2), rounded to the nearest pixel -> (N,) """
+    H, W = flow.shape[-2:]
+    flow = flow.reshape(H, W)
+    mask = mask.reshape(-1, H, W)
+    factor = upsample_factor(mask)
+
+    points = np.rint(points).astype(np.int64)
+    x = np.clip(points[:, 0], 0, factor * W - 1)
+    y = np.clip(points[:, 1], 0, factor * H - 1)
+    h, i = np.divmod(y, factor)
+    w, j = np.divmod(x, factor)
+
+    logits = mask.reshape(9, factor * factor, H, W)[:, i * factor + j, h, w].astype(np.float32)
+    weights = np.exp(logits - logits.max(axis=0))
+    weights /= weights.sum(axis=0)
+
+    padded = np.pad(factor * flow.astype(np.float32), 1)
+    neighbors = padded[h + _KY[:, None], w + _KX[:, None]]
+    return (weights * neighbors).sum(axis=0)